@@ -0,0 +1,145 @@
+#!/usr/local/bin/python3
+""" Benchmark the DMRR submission preparation on synthetic sample sheets
+
+Usage:
+    benchmark.py [--sizes=<sizes>] [--designs=<designs>] [--backends=<backends>] [--output=<json>] [--compare=<json>]
+
+Options:
+    -h --help               print this help message
+    --sizes=<sizes>         comma-separated numbers of samples per study [default: 100,1000,10000,100000]
+    --designs=<designs>     comma-separated study designs: single_source, multi_source, time_series [default: single_source,multi_source,time_series]
+    --backends=<backends>   comma-separated backends: pandas, python [default: pandas,python]
+    --output=<json>         file to save the results to [default: benchmark_results.json]
+    --compare=<json>        results from an earlier run to compare against
+
+"""
+import contextlib
+import csv
+import datetime
+import docopt
+import dmrr_prep
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+STUDY_ID = 'EXR-MTEWA1Benchmark'
+RACES = ['Asian', 'asian', 'Black or African American', 'mixed/asian & white', 'White', 'white', 'Pacific Islander', 'Other', '']
+GENDERS = ['Male', 'female', 'MALE', 'Female', '']
+AGES = [25, 31, 40, 52, 67, 200, '']
+
+
+def write_sample_sheet(samples_filename, fastq_filenames, n_samples, design):
+    """ Write a synthetic sample sheet & fastq filename list with n_samples in the benchmark study plus as many in another study """
+    random.seed(n_samples)
+    samples_per_participant = {'single_source': 1, 'multi_source': 2, 'time_series': 11}[design]
+    with open(samples_filename, 'w', newline='') as samples_file, open(fastq_filenames, 'w') as fastq_file:
+        writer = csv.writer(samples_file)
+        writer.writerow(['Participant.ID', 'Sample.ID', 'MT.Unique.ID', 'Source', 'Study', 'MISEQ.QC.PASS', 'Age', 'Race', 'Gender', 'Notes'])
+        mt_unique_id = 0
+        for study in ('Benchmark', 'Other Study'):
+            for participant in range(-(-n_samples // samples_per_participant)):
+                participant_id = '{}{:06d}'.format(study[0], participant)
+                age, race, gender = random.choice(AGES), random.choice(RACES), random.choice(GENDERS)
+                timestep = random.choice(['30 min', '1 hr'])
+                for sample in range(samples_per_participant):
+                    mt_unique_id += 1
+                    if design == 'time_series':
+                        sample_id, source, study_name = participant_id + ('-T{}'.format(sample) if sample else ''), 'Plasma', study + '-' + timestep
+                    else:
+                        sample_id, source, study_name = participant_id, ['Plasma', 'Serum'][sample], study
+                    writer.writerow([participant_id, sample_id, mt_unique_id, source, study_name, 'PASS', age, race, gender, 'synthetic'])
+                    fastq_file.write('{}_S{}_L001_R1_001.fastq.gz\n'.format(mt_unique_id, mt_unique_id))
+
+
+def study_config(samples_filename, fastq_filenames, design, working_dir):
+    """ Config of the benchmark study in the synthetic sample sheet """
+    is_time_series = design == 'time_series'
+    return {'group': 'group', 'user_login': 'benchmark', 'study_name': 'Benchmark', 'samples_filename': samples_filename,
+            'sample_study_names': ['Benchmark-30 min', 'Benchmark-1 hr'] if is_time_series else ['Benchmark'], 'study_id': STUDY_ID, 'working_dir': working_dir,
+            'templates_dir': TEMPLATES_DIR, 'is_time_series': is_time_series, 'database': 'hg19_exrna', 'md5sum': 'md5sum', 'fastq_filenames': fastq_filenames, 'tar_archive': None}
+
+
+def run_submission(config, backend):
+    """ Prepare the study end to end, as the first run of a new study would: build state, validation and all, in an empty working_dir,
+    without the templates, validators & fastq index cached by earlier runs. Returns its run report
+    """
+    dmrr_prep.TEMPLATES.clear()
+    dmrr_prep.VALIDATORS.clear()
+    index_filename = config['fastq_filenames'] + '.index.json'
+    if os.path.exists(index_filename):
+        os.remove(index_filename)
+    shutil.rmtree(config['working_dir'], ignore_errors=True)
+    os.makedirs(config['working_dir'])
+    return dmrr_prep.Submission.from_config_dict(config, report=True, backend=backend).report
+
+
+def benchmark(n_samples, design, backend):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        samples_filename = os.path.join(temp_dir, 'sample_sheet.csv')
+        fastq_filenames = os.path.join(temp_dir, 'fastq_filenames.txt')
+        write_sample_sheet(samples_filename, fastq_filenames, n_samples, design)
+        config = study_config(samples_filename, fastq_filenames, design, os.path.join(temp_dir, 'out'))
+        # time the stages without tracing, then run them again to measure the peak memory of each
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = run_submission(config, backend)
+            stages = {stage['name']: {'seconds': stage['wall_seconds']} for stage in report['stages']}
+            tracemalloc.start()
+            try:
+                for stage in run_submission(config, backend)['stages']:
+                    stages[stage['name']]['peak_memory_bytes'] = stage['peak_memory_bytes']
+            finally:
+                tracemalloc.stop()
+    return {'design': design, 'n_samples': n_samples, 'backend': report['backend'], 'stages': stages, 'total_seconds': report['wall_seconds']}
+
+
+def warm_up(designs, backends):
+    """ Run a small study with each backend first, so the first timed run doesn't include importing pandas & the other lazily imported modules """
+    for backend in backends:
+        for design in designs:
+            benchmark(100, design, backend)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, earlier_results):
+    earlier = {(result['design'], result['n_samples'], result.get('backend', 'pandas')): result for result in earlier_results['results']}  # runs from before the backends were benchmarked used pandas
+    print('Compared to {} ({}):'.format(earlier_results['commit'], earlier_results['date']))
+    for result in results['results']:
+        before = earlier.get((result['design'], result['n_samples'], result['backend']))
+        if before:
+            print('\t{}\t{}\t{}\t{:.2f}x the time'.format(result['design'], result['n_samples'], result['backend'], result['total_seconds'] / before['total_seconds']))
+
+
+def main(args):
+    results = {'commit': git_commit(), 'date': datetime.datetime.now().isoformat(), 'python': platform.python_version(), 'results': list()}
+    designs, backends = args['--designs'].split(','), args['--backends'].split(',')
+    warm_up(designs, backends)
+    for design in designs:
+        for n_samples in [int(size) for size in args['--sizes'].split(',')]:
+            for backend in backends:
+                result = benchmark(n_samples, design, backend)
+                results['results'].append(result)
+                print('{}\t{}\t{}\t{:.3f} s\t'.format(design, n_samples, result['backend'], result['total_seconds']) +
+                      '\t'.join('{} {:.3f} s {:.1f} MB'.format(stage, times['seconds'], times['peak_memory_bytes'] / 2 ** 20) for stage, times in result['stages'].items()))
+    with open(args['--output'], 'w') as file:
+        json.dump(results, file, indent=4)
+    if args['--compare']:
+        with open(args['--compare'], 'r') as file:
+            compare(results, json.load(file))
+
+
+if __name__ == "__main__":
+    arguments = docopt.docopt(__doc__)
+    main(arguments)
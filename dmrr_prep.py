@@ -5,27 +5,146 @@ Email: sovacool@umich.edu
 Date: July 2018
 
 Usage:
-    dmrr_prep.py <config_filename>
+    dmrr_prep.py [--backend=<backend>] [--processes=<n>] [--report] [--profile] <config_filename>
+    dmrr_prep.py batch [--processes=<n>] [--report] [--profile] <config_path>...
 
 Options:
-    -h --help   print this help message
+    -h --help           print this help message
+    --processes=<n>     number of studies, or packages of a study, to prepare at once (default: number of CPUs)
+    --backend=<backend> pandas, python, or auto to use python for small sample sheets (default: backend in the config, else auto)
+    --report            save the wall time, cpu time, peak memory and size of each stage to <study_id>.report.json in working_dir
+    --profile           save a cProfile of the run to <study_id>.prof in working_dir
+
+Batch mode prepares every config file given, or every .yaml file in a given directory,
+sharing the parsed sample sheets and templates between studies.
 
 """
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import csv
 import datetime
 import docopt
+import functools
+import glob
+import hashlib
+import importlib
 import json
-import numpy as np
 import os
-import pandas as pd
+import platform
 import pprint
+import re
+import sys
+import tarfile
 import yaml
 import time
+import traceback
+import tracemalloc
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+class LazyModule:
+    """ A module that's only imported when one of its attributes is first used, so runs that don't need it start quickly """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
 
 MISSING = "#MISSING#"
+SAMPLE_SHEET_COLUMNS = ['Participant.ID', 'Sample.ID', 'MT.Unique.ID', 'Source', 'Study', 'MISEQ.QC.PASS', 'Age', 'Race', 'Gender']
+CATEGORICAL_COLUMNS = ['Study', 'Source', 'MISEQ.QC.PASS']
+SAMPLE_COLUMNS = ['Participant.ID', 'Sample.ID', 'Study', 'donor.id']  # of each source's samples, besides MT.Unique.ID, that its biosamples are built from
+TIME_SERIES_COLUMNS = ['timepoint', 'timestep']
+CHUNK_SIZE = 100000  # sample sheet rows parsed at a time
+BLOCK_SIZE = 16 * 2 ** 20  # bytes read at a time when checksumming archives
+FASTQ_EXTENSIONS = ('.fastq', '.fastq.gz', '.fq', '.fq.gz')
+FASTQ_ID_PATTERN = r'(\d+)_'  # MT.Unique.ID at the start of fastq filenames, e.g. 1001_S1001_L001_R1_001.fastq.gz
+FASTQ_READ_PATTERN = r'_R([12])[_.]'  # read 1 or 2 of paired-end fastq files; files without it are read 1
+BACKENDS = ('auto', 'pandas', 'python')
+PYTHON_BACKEND_MAX_BYTES = 4 * 2 ** 20  # auto backend uses python for sample sheets up to this size (~30k samples), pandas for larger ones
+# strings read_csv treats as missing or boolean by default, for reading files the way pandas would without it
+NA_VALUES = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+BOOL_VALUES = {'True': True, 'TRUE': True, 'true': True, 'False': False, 'FALSE': False, 'false': False}
+INT_PATTERN = re.compile(r'\s*[-+]?\d+\s*')
+FLOAT_PATTERN = re.compile(r'\s*[-+]?(\d+\.?\d*([eE][-+]?\d+)?|\.\d+([eE][-+]?\d+)?|inf|infinity)\s*', re.IGNORECASE)
+TEMPLATES = dict()  # compiled templates by (filename, is_time_series) or (filename, is_time_series, 'python'), shared by all submissions in this process
+VALIDATORS = dict()  # checks compiled from each template, by (filename, is_time_series)
+VALIDATION_MODES = ('warn', 'error', 'off')
+VECTORIZED_VALIDATION_MIN_RECORDS = 1000  # documents with fewer records are checked without pandas, which is quicker for them
+# patterns present values of each template domain must match, besides enum(), regexp(), autoID() & measurement(); other domains like string & bioportalTerm aren't checked
+DOMAIN_PATTERNS = {'int': r'[-+]?\d+', 'posInt': r'\+?0*[1-9]\d*', 'numItems': r'\d+', 'url': r'\S+',
+                   'date': r'\d{4}-\d{1,2}-\d{1,2}|\d{1,2}/\d{1,2}/\d{2,4}', 'timestamp': r'\d{4}-\d{1,2}-\d{1,2}([ T]\d{1,2}:\d{2}(:\d{2})?)?'}
+TEMPLATE_NAMES = ['Biosamples', 'Donors']  # templates of the documents built here, preloaded for batches; the others are filled in by the user
+# rows to drop from each template, then rows to insert as (position, property, property to copy or {column: value})
+TEMPLATE_LAYOUTS = {'Donors': {'drop': ['- Ethnic Group', '-- Current Health Status', '-- Medical History', '-- Smoking History', '-- Medications', '-- Treatment History',
+                                        '-- Family History', '-- Developmental Stage', '- Has Expired?', '-- Estimated Date',
+                                        '-- Post-mortem Interval', '- Notes', '* Family Members', '*- Family Member', '*-- Relationship', '*-- DocURL', '* Aliases', '*-  Accession',
+                                        '*-- dbName', '*-- URL', '- Health Status', '*-- Notes']},
+                    'Biosamples': {'drop': ['-- Age at Sampling', '-- Notes', '- Description', '--- Symptoms', '--- Pathology', '--- Disease Duration',
+                                            '--- Collection Details',
+                                            '---- Sample Collection Method', '---- Geographic Location',
+                                            '---- Collection Date', '---- Time of Collection',
+                                            '---- Collection Tube Type', '----- Other Collection Tube Type',
+                                            '---- Holding Time', '---- Holding Temperature',
+                                            '---- Preservatives Used', '---- Freezing Method',
+                                            '---- Number of Times Freeze Thawed',
+                                            '---- Contamination Removal Method', '--- Notes',
+                                            '-- Cell Culture Supernatant', '--- Source', '---- Type',
+                                            '---- Cell Line', '---- Start Date', '---- Harvest Date', '--- Tissue',
+                                            '---- Date Obtained', '---- Tissue Type',
+                                            '-- Starting Amount', '-- Replicate Information',
+                                            '--- Biological Replicate Number', '--- Technical Replicate Number', '-- Provider', '--- Company Name', '--- Lab Name', '--- Person Name',
+                                            '* Pooled Biosamples', '*- Pooled Biosample', '*-- DocURL', '* Aliases', '*-  Accession', '*-- dbName', '*-- URL',
+                                            '*-- Date Submitted to External Database', '*-- Notes'],
+                                   'insert': [(18, '*-- DocURL', {'domain': 'URL', 'description': 'Relative ID (accession) of doc, provide Document URL'})],
+                                   'time_series_insert': [(23, '*- Property Name2', '*- Property Name'), (24, '*-- Value2', '*-- Value'),
+                                                          (25, '*- Property Name3', '*- Property Name'), (26, '*-- Value3', '*-- Value'),
+                                                          (27, '*- Property Name4', '*- Property Name'), (28, '*-- Value4', '*-- Value')]}}
+SAMPLE_SHEETS = dict()  # sample sheets loaded for a batch, by filename
+TIMEPOINTS = {"1 hr": {"T0": 'Fasting blood draw',
+                       "T1": "1 hr post meal 1",
+                       "T2": "2 hrs post meal 1",
+                       "T3": "3 hrs post meal 1",
+                       "T4": "4 hrs post meal 1",
+                       "T5": "1 hr post meal 2",
+                       "T6": "2 hrs post meal 2",
+                       "T7": "3 hrs post meal 2",
+                       "T8": "4 hrs post meal 2",
+                       "T9": "24 hrs post meal 2",
+                       "T10": "48 hrs post meal 2"},
+              "30 min": {"T0": 'Fasting blood draw',
+                         "T1": "0.5 hr post meal 1",
+                         "T2": "1 hr post meal 1",
+                         "T3": "1.5 hrs post meal 1",
+                         "T4": "2 hrs post meal 1",
+                         "T5": "2.5 hrs post meal 1",
+                         "T6": "3 hrs post meal 1",
+                         "T7": "3.5 hrs post meal 1",
+                         "T8": "4 hrs post meal 1",
+                         "T9": "24 hrs post meal 2",
+                         "T10": "48 hrs post meal 2"}}
 
 
 class Submission:
-    def __init__(self, group, user_login, study_name, samples_filename, sample_study_names, study_id, working_dir, templates_dir, md5sum, fastq_filenames, is_time_series, database):
+    """ The donors, biosamples & manifest files of a study, built with pandas.
+    LightSubmission builds them with plain python instead, by overriding the steps that load the samples and build the documents.
+    """
+    backend = 'pandas'
+
+    def __init__(self, group, user_login, study_name, samples_filename, sample_study_names, study_id, working_dir, templates_dir, md5sum, fastq_filenames, is_time_series, database, cache_dir=None, ontology_filename=None, tar_archive=None, background_hashing=True, sample_sheet=None, incremental=True, validation='warn', report=False, profile=False, donor_ids=None, biosample_ids=None, package=None, study_sources=None,
+                 fastq_dir=None, fastq_id_pattern=FASTQ_ID_PATTERN, fastq_read_pattern=FASTQ_READ_PATTERN):
         self.group = group
         self.user_login = user_login
         self.study_name = study_name
@@ -35,34 +154,282 @@ class Submission:
         self.is_time_series = is_time_series
         self.database = database
 
-        # load all the data
-        self.samples = Samples(samples_filename, sample_study_names, is_time_series)
-        self.participants = Participants(samples_filename, sample_study_names, is_time_series)
-        self.donors = Donors(templates_dir, self.participants.df, study_id, is_time_series)
-        self.biosamples = Biosamples(study_id, templates_dir, working_dir, self.participants.df, self.samples.df, is_time_series)
-        self.manifest = Manifest(self.biosamples, working_dir, templates_dir, fastq_filenames, self.samples, study_id, study_name, user_login, md5sum, group, database)
+        self.report = RunReport(os.path.join(working_dir, study_id + '.report.json') if report else None, os.path.join(working_dir, study_id + '.prof') if profile else None)
+        with self.report.run(study_id):  # stops the profiler even if a stage fails
+            # start checksumming the tar archive while the metadata is built
+            self.archive = TarArchive(tar_archive) if tar_archive and tar_archive != 'None' else None
+            if self.archive:
+                self.archive.scan(background=background_hashing)
+
+            # load all the data
+            ontology_filename = ontology_filename or os.path.join(templates_dir, 'ontology.yaml')
+            self.load(samples_filename, sample_study_names, study_id, is_time_series, ontology_filename, sample_sheet=sample_sheet, cache_dir=cache_dir, donor_ids=donor_ids)
+
+            # only rebuild the documents whose inputs changed since the last run, hashed the same way whichever backend loaded them
+            with self.report.stage('BuildState'):
+                self.state = BuildState(os.path.join(working_dir, study_id + '.build_state.json') if incremental else None)
+                settings = hash_inputs(file_md5(__file__), group, user_login, study_name, sorted(sample_study_names), study_id, is_time_series, database, sorted(study_sources) if study_sources else None, package)
+                donors_filename = os.path.join(working_dir, study_id + '-DO.metadata.tsv')
+                donors_inputs = hash_inputs(settings, file_md5(os.path.join(templates_dir, 'Donors.template.tsv')), file_md5(ontology_filename), hash_columns(self.participant_columns()))
+                biosamples_template = file_md5(os.path.join(templates_dir, 'Biosamples.template.tsv'))
+                samples = self.sample_columns()
+                sources = sorted(samples)
+                biosamples_filenames = Biosamples.filenames(study_id, working_dir, study_sources or sources)
+                biosamples_inputs = {source: hash_inputs(settings, biosamples_template, hash_columns(columns), [biosample_ids[mt_unique_id] for mt_unique_id in columns['MT.Unique.ID']] if biosample_ids else None)
+                                     for source, columns in samples.items()}
+                rebuild_sources = [source for source, inputs in biosamples_inputs.items() if not self.state.is_current(biosamples_filenames[source], inputs)]
+
+            with self.report.stage('Donors') as stage:
+                self.donors = self.build_donors(templates_dir, study_id, is_time_series, cache_dir=cache_dir) if not self.state.is_current(donors_filename, donors_inputs) else None
+                if self.donors is not None:
+                    RunReport.count(stage, self.donors)
+            with self.report.stage('Biosamples') as stage:
+                self.biosamples = self.build_biosamples(study_id, templates_dir, is_time_series, rebuild_sources, cache_dir=cache_dir, biosample_ids=biosample_ids)  # {source: document}
+                RunReport.count(stage, *self.biosamples.values())
+            with self.report.stage('Manifest') as stage:
+                if self.archive:
+                    self.md5sum, fastq_filenames = self.archive.result()
+                fastq_index = FastqIndex.load(fastq_filenames if self.archive or not fastq_dir else fastq_dir, fastq_id_pattern, fastq_read_pattern)
+                sample_sources = {mt_unique_id: source for source, columns in samples.items() for mt_unique_id in columns['MT.Unique.ID']}
+                self.manifest = Manifest(study_sources or sources, working_dir, templates_dir, fastq_index, sample_sources, study_id, study_name, user_login, self.md5sum, group, database, package=package)
+                manifest_filename = os.path.join(working_dir, study_id + '.manifest.json')
+                manifest_inputs = hash_inputs(settings, self.md5sum, file_md5(os.path.join(templates_dir, 'manifest_template.manifest.json')), sorted(sample_sources.items()), sorted(self.manifest.fastq_filenames.items()))
+                stage['rows'] = len(self.manifest['manifest'])
+
+            # Save the files that changed, leaving the others untouched
+            documents = {donors_filename: ('Donors', self.donors, donors_inputs)}
+            documents.update({biosamples_filenames[source]: ('Biosamples', self.biosamples.get(source), inputs) for source, inputs in biosamples_inputs.items()})
+            documents[manifest_filename] = (None, self.manifest, manifest_inputs)
+            with self.report.stage('Validate') as stage:
+                self.validate(documents, os.path.join(working_dir, study_id + '.validation.json'), templates_dir, is_time_series, validation)
+                stage['rows'] = self.validation.count()
+            with self.report.stage('write'):
+                self.save(documents)
+        self.report.finish(rebuilt=self.rebuilt, backend=self.backend)
 
-        # Save all the files
-        self.donors.write(os.path.join(working_dir, self.manifest['donorMetadataFileName']))
-        self.biosamples.write()
-        self.manifest.write()
+    def load(self, samples_filename, sample_study_names, study_id, is_time_series, ontology_filename, sample_sheet=None, cache_dir=None, donor_ids=None):
+        """ Load the samples of the studies that passed QC, and their participants with ontology terms & donor ids """
+        with self.report.stage('SampleSheet') as stage:
+            self.sample_sheet = SampleSheet(samples_filename, sample_study_names, cache_dir=cache_dir, dataframe=sample_sheet)
+            RunReport.count(stage, self.sample_sheet)
+        with self.report.stage('Samples') as stage:
+            self.samples = Samples(self.sample_sheet.df, is_time_series)
+            RunReport.count(stage, self.samples)
+        with self.report.stage('Participants') as stage:
+            self.participants = Participants(self.sample_sheet.df, is_time_series, ontology_filename)
+            assign_donor_ids(self.participants.df, study_id, donor_ids)
+            RunReport.count(stage, self.participants)
+
+    def participant_columns(self):
+        """ {column: values} of the participants, in the order they're numbered, as plain python values that are the same for either backend """
+        participants = self.participants.df
+        return dict({'Participant.ID': participants.index.tolist()}, **{column: participants[column].tolist() for column in ('Age', 'Race', 'Gender', 'donor.id')})
+
+    def sample_columns(self):
+        """ {source: {column: values}} of the samples from each source, in MT.Unique.ID order with their participant's donor.id, the same for either backend """
+        samples = self.samples.df.sort_index().join(self.participants.df['donor.id'], on='Participant.ID')
+        return {source: dict({'MT.Unique.ID': source_samples.index.tolist()}, **{column: source_samples[column].tolist() for column in SAMPLE_COLUMNS + (TIME_SERIES_COLUMNS if self.is_time_series else [])})
+                for source, source_samples in samples.groupby('Source', sort=False, observed=True)}
+
+    def build_donors(self, templates_dir, study_id, is_time_series, cache_dir=None):
+        return Donors(templates_dir, self.participants.df, study_id, is_time_series, cache_dir=cache_dir)
+
+    def build_biosamples(self, study_id, templates_dir, is_time_series, sources, cache_dir=None, biosample_ids=None):
+        """ {source: document} for the given sources """
+        return Biosamples(study_id, templates_dir, self.participants.df, self.samples.df, is_time_series, sources=sources, cache_dir=cache_dir, biosample_ids=biosample_ids).dfs
+
+    def validate(self, documents, report_filename, templates_dir, is_time_series, mode='warn'):
+        """ Check the rebuilt documents against the domain & required columns of their templates, keeping the problems found earlier in the others.
+        The problems are printed and saved to report_filename; in 'error' mode they also stop the documents from being written.
+        """
+        if mode not in VALIDATION_MODES:
+            raise ValueError('validation must be one of {}, not {!r}'.format(', '.join(VALIDATION_MODES), mode))
+        self.validation = ValidationReport(report_filename if mode != 'off' else None)
+        if mode == 'off':
+            return
+        for filename, (name, document, inputs) in documents.items():
+            if name and document is not None and not self.state.is_current(filename, inputs):
+                self.validation[os.path.basename(filename)] = template_validator(templates_dir, name, is_time_series).validate(document)
+        for filename in set(self.validation) - set(os.path.basename(filename) for filename in documents):  # no longer an output
+            del self.validation[filename]
+        self.validation.write()
+        self.validation.print_problems()
+        if mode == 'error' and self.validation.count():
+            raise ValueError('{} problem(s) found validating the documents, see {}'.format(self.validation.count(), report_filename))
+
+    @property
+    def filenames(self):
+        """ Metadata files the user still has to fill in """
+        return self.manifest.filenames
+
+    def save(self, documents):
+        """ Write the documents whose inputs changed, given {output filename: (template name, document or None if it wasn't rebuilt, inputs)},
+        and remove the outputs of earlier runs that are no longer made, e.g. a source's biosamples file after its samples are dropped
+        """
+        self.rebuilt = list()
+        for filename, (name, document, inputs) in documents.items():
+            if document is not None and not self.state.is_current(filename, inputs):
+                document.write(filename)
+                self.state.update(filename, inputs)
+                self.rebuilt.append(filename)
+        self.removed = self.state.remove(set(os.path.basename(filename) for filename in documents))
+        self.state.write()
 
     @classmethod
-    def from_config_dict(cls, config):
-        return cls(config['group'], config['user_login'], config['study_name'], config['samples_filename'], config['sample_study_names'], config['study_id'], config['working_dir'], config['templates_dir'], config['md5sum'], config['fastq_filenames'], config['is_time_series'], config['database'])
+    def from_config_dict(cls, config, sample_sheet=None, report=False, profile=False, backend=None, processes=None, donor_ids=None, biosample_ids=None, package=None, study_sources=None):
+        backend = backend or config.get('backend', 'auto')
+        if backend not in BACKENDS:
+            raise ValueError('backend must be one of {}, not {!r}'.format(', '.join(BACKENDS), backend))
+        validation = config.get('validation', 'warn')
+        validation = {True: 'warn', False: 'off'}.get(validation, validation)  # yaml reads off as False
+        if validation not in VALIDATION_MODES:
+            raise ValueError('validation must be one of {}, not {!r}'.format(', '.join(VALIDATION_MODES), validation))
+        python_backend = cls is Submission and sample_sheet is None and (backend == 'python' or (backend == 'auto' and os.path.getsize(config['samples_filename']) <= PYTHON_BACKEND_MAX_BYTES))
+        if cls is Submission and config.get('max_samples_per_package'):
+            if python_backend:  # count the samples without pandas, which a study that fits in one submission won't need
+                study_names = set(config['sample_study_names'])
+                n_samples = len(read_table(config['samples_filename'], ['Study', 'MISEQ.QC.PASS'], keep=lambda values: values[0] in study_names and values[1] == 'PASS', text_columns=['Study', 'MISEQ.QC.PASS']).rows)
+            else:
+                sample_sheet = SampleSheet(config['samples_filename'], config['sample_study_names'], cache_dir=config.get('cache_dir'), dataframe=sample_sheet).df
+                n_samples = len(sample_sheet.index)
+            if n_samples > config['max_samples_per_package']:  # packages are always prepared with pandas
+                if sample_sheet is None:
+                    sample_sheet = SampleSheet(config['samples_filename'], config['sample_study_names'], cache_dir=config.get('cache_dir')).df
+                return PackagedSubmission(config, sample_sheet, report=report, profile=profile, processes=processes)
+        if python_backend:
+            cls = LightSubmission
+        submission = cls(config['group'], config['user_login'], config['study_name'], config['samples_filename'], config['sample_study_names'], config['study_id'], config['working_dir'], config['templates_dir'], config.get('md5sum'), config.get('fastq_filenames'), config['is_time_series'], config['database'],
+                       cache_dir=config.get('cache_dir'), ontology_filename=config.get('ontology_filename'), tar_archive=config.get('tar_archive'), background_hashing=config.get('background_hashing', True),
+                       sample_sheet=sample_sheet, incremental=config.get('incremental', True), validation=validation, report=report, profile=profile,
+                       donor_ids=donor_ids, biosample_ids=biosample_ids, package=package, study_sources=study_sources,
+                       fastq_dir=config.get('fastq_dir'), fastq_id_pattern=config.get('fastq_id_pattern', FASTQ_ID_PATTERN), fastq_read_pattern=config.get('fastq_read_pattern', FASTQ_READ_PATTERN))
+        if package is None:  # the study fits in one submission now, so its packages from earlier runs are stale
+            submission.removed += remove_stale_packages(config['working_dir'], config['study_id'])
+        return submission
+
+
+class LightSubmission(Submission):
+    """ The same submission built with plain python lists & dicts instead of pandas, which is quicker for small sample sheets """
+    backend = 'python'
+
+    def load(self, samples_filename, sample_study_names, study_id, is_time_series, ontology_filename, sample_sheet=None, cache_dir=None, donor_ids=None):
+        """ Submission.load as one {column: value} dict per row """
+        with self.report.stage('SampleSheet') as stage:
+            study_names = set(sample_study_names)
+            study, qc = SAMPLE_SHEET_COLUMNS.index('Study'), SAMPLE_SHEET_COLUMNS.index('MISEQ.QC.PASS')
+            self.sample_sheet = read_table(samples_filename, SAMPLE_SHEET_COLUMNS, keep=lambda values: values[study] in study_names and values[qc] == 'PASS', text_columns=CATEGORICAL_COLUMNS)
+            RunReport.count(stage, self.sample_sheet)
+        with self.report.stage('Samples') as stage:
+            self.samples = sorted(self.sample_sheet.records(), key=lambda sample: sample['MT.Unique.ID'])
+            if is_time_series:
+                for sample in self.samples:
+                    sample['timepoint'] = sample['Sample.ID'].split('-')[1] if len(sample['Sample.ID'].split('-')) > 1 else 'T0'
+                    sample['timestep'] = sample['Study'].split('-')[1] if len(sample['Study'].split('-')) > 1 else 'NA'
+            stage['rows'] = len(self.samples)
+        with self.report.stage('Participants') as stage:
+            self.participants = [{column: sample[column] for column in ('Participant.ID', 'Age', 'Race', 'Gender')} for sample in self.sample_sheet.records()
+                                 if isinstance(sample['Source'], str) and sample['Source'].capitalize() == 'Plasma' and (not is_time_series or len(sample['Sample.ID'].split('-')) == 1 or sample['Sample.ID'].split('-')[1] == 'T0')]
+            Ontology.print_unmatched(Ontology(ontology_filename).normalize_records(self.participants))
+            for index, participant in enumerate(self.participants):
+                participant['donor.id'] = donor_ids[participant['Participant.ID']] if donor_ids else study_id + str(index + 1) + '-DO'
+            stage['rows'] = len(self.participants)
+
+    def participant_columns(self):
+        return {column: [participant[column] for participant in self.participants] for column in ('Participant.ID', 'Age', 'Race', 'Gender', 'donor.id')}
+
+    def sample_columns(self):
+        donor_ids = {participant['Participant.ID']: participant['donor.id'] for participant in self.participants}
+        columns = ['MT.Unique.ID'] + SAMPLE_COLUMNS + (TIME_SERIES_COLUMNS if self.is_time_series else [])
+        samples = dict()
+        for sample in self.samples:
+            if sample['Source'] is None:  # left out like pandas' groupby does
+                continue
+            source_samples = samples.setdefault(sample['Source'], {column: list() for column in columns})
+            for column in columns:
+                source_samples[column].append(donor_ids.get(sample['Participant.ID']) if column == 'donor.id' else sample[column])
+        return samples
+
+    def build_donors(self, templates_dir, study_id, is_time_series, cache_dir=None):
+        return fill_table(compile_table_template(templates_dir, 'Donors', is_time_series), ['value' + participant['Participant.ID'] for participant in self.participants],
+                          donor_fields(is_time_series, *[[participant[column] for participant in self.participants] for column in ('donor.id', 'Participant.ID', 'Gender', 'Race', 'Age')]))
+
+    def build_biosamples(self, study_id, templates_dir, is_time_series, sources, cache_dir=None, biosample_ids=None):
+        template = compile_table_template(templates_dir, 'Biosamples', is_time_series)
+        biosamples = dict()  # one table per source
+        for source, columns in self.sample_columns().items():
+            if source in sources:
+                biosamples[source] = fill_table(template, ['value' + str(mt_unique_id) for mt_unique_id in columns['MT.Unique.ID']],
+                                                biosample_fields(study_id, is_time_series, source, columns['MT.Unique.ID'], columns['Participant.ID'], columns['donor.id'],
+                                                                 columns.get('timepoint'), columns.get('timestep'),
+                                                                 biosample_ids=[biosample_ids[mt_unique_id] for mt_unique_id in columns['MT.Unique.ID']] if biosample_ids else None))
+        return biosamples
+
+
+class PackagedSubmission:
+    """ A study too big for one submission, split into packages of at most max_samples_per_package samples that are prepared in parallel,
+    each in its own package<n> directory in working_dir. A participant's samples are kept in one package, and packages are filled in sample sheet order
+    so adding participants to a study doesn't move the others. Donors & biosamples are numbered across the whole study, so their ids are the same in any package,
+    and every package names its files after all the study's sources. Each package gets a <study_id>.fastq.tar archive of the fastq files its manifest lists,
+    from tar_archive or fastq_dir, and its manifest has that archive's md5sum, so it can be uploaded on its own. The outputs of earlier runs that are
+    no longer made, in working_dir itself or in package directories past the last package, are removed.
+    """
+    def __init__(self, config, sample_sheet, report=False, profile=False, processes=None):
+        self.study_id = config['study_id']
+        donor_ids, biosample_ids = study_ids(sample_sheet, config['study_id'], config['is_time_series'])
+        self.packages = split_packages(sample_sheet, config['max_samples_per_package'])
+        self.package_samples = [int(sample_sheet['Participant.ID'].isin(participant_ids).sum()) for participant_ids in self.packages]
+        oversized = ['package{} ({} samples)'.format(package, samples) for package, samples in enumerate(self.package_samples, start=1) if samples > config['max_samples_per_package']]
+        if oversized:  # a participant's samples, e.g. all the timepoints of a time series, are never split between packages
+            print('Warning: {} of {} packages have more than max_samples_per_package ({}) samples, because one participant has more samples than that: {}'.format(
+                len(oversized), len(self.packages), config['max_samples_per_package'], ', '.join(oversized)))
+        study_sources = sorted(set(sample_sheet['Source']))
+
+        # index the fastq files once for all the packages, then give each package an archive of its own fastq files, with its own md5sum
+        config = dict(config, max_samples_per_package=None)
+        id_pattern, read_pattern = config.get('fastq_id_pattern', FASTQ_ID_PATTERN), config.get('fastq_read_pattern', FASTQ_READ_PATTERN)
+        tar_archive = config['tar_archive'] if config.get('tar_archive') and config['tar_archive'] != 'None' else None
+        if tar_archive:
+            fastq_index = FastqIndex(TarArchive(tar_archive).result()[1], id_pattern, read_pattern)
+        elif config.get('fastq_dir'):
+            fastq_index = FastqIndex.load(config['fastq_dir'], id_pattern, read_pattern)
+        else:
+            raise ValueError('{} is split into packages, which each need an archive of their own fastq files with its own md5sum: set tar_archive or fastq_dir instead of md5sum and fastq_filenames'.format(self.study_id))
+        fastq_filenames = fastq_index.resolve(sample_sheet['MT.Unique.ID'])  # so no package is written if any sample's fastq file is missing
+        package_sheets = [sample_sheet.loc[sample_sheet['Participant.ID'].isin(participant_ids)] for participant_ids in self.packages]
+        self.working_dirs = [os.path.join(config['working_dir'], 'package{}'.format(package)) for package in range(1, len(self.packages) + 1)]
+        self.archive_filenames = [os.path.join(working_dir, self.study_id + '.fastq.tar') for working_dir in self.working_dirs]
+        for working_dir in self.working_dirs:
+            if not os.path.exists(working_dir):
+                os.makedirs(working_dir)
+        md5sums, archives_written = write_package_archives({archive_filename: [fastq_filenames[mt_unique_id] for mt_unique_id in package_sheet['MT.Unique.ID']]
+                                                            for archive_filename, package_sheet in zip(self.archive_filenames, package_sheets)}, tar_archive=tar_archive, fastq_dir=config.get('fastq_dir'))
+        config['tar_archive'] = config['fastq_dir'] = None
+
+        arguments = list()
+        for package, (participant_ids, package_sheet, working_dir, archive_filename) in enumerate(zip(self.packages, package_sheets, self.working_dirs, self.archive_filenames), start=1):
+            package_config = dict(config, working_dir=working_dir, md5sum=md5sums[archive_filename], fastq_filenames=fastq_index.subset(package_sheet['MT.Unique.ID']))
+            arguments.append((package_config, package_sheet, {part_id: donor_ids[part_id] for part_id in participant_ids if part_id in donor_ids},
+                              {mt_unique_id: biosample_ids[mt_unique_id] for mt_unique_id in package_sheet['MT.Unique.ID']}, package, study_sources, report, profile))
+        if processes == 1:
+            results = [prepare_package(*package_arguments) for package_arguments in arguments]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_batch_worker, initargs=(dict(), TEMPLATES)) as executor:
+                results = list(executor.map(prepare_package, *zip(*arguments)))
+        self.rebuilt = archives_written + [filename for rebuilt, removed, filenames in results for filename in rebuilt]
+        self.filenames = [os.path.join(working_dir, filename) for working_dir, (rebuilt, removed, filenames) in zip(self.working_dirs, results) for filename in filenames]
+        self.removed = [filename for rebuilt, removed, filenames in results for filename in removed]
+        self.removed += remove_study_outputs(config['working_dir'], self.study_id) + remove_stale_packages(config['working_dir'], self.study_id, len(self.packages))
 
 
 class Manifest(dict):
-    def __init__(self, biosamples, working_dir, templates_dir, fastq_filenames, samples, study_id, study_name, user_login, md5sum, group, database):
+    def __init__(self, sources, working_dir, templates_dir, fastq_index, sample_sources, study_id, study_name, user_login, md5sum, group, database, package=None):
         with open(os.path.join(templates_dir, 'manifest_template.manifest.json'), 'r') as template_file:
             super().__init__(json.load(template_file))
         self.study_id = study_id
         self.working_dir = working_dir
 
         # Fill in the manifest metadata
-        # TODO: option to supply list of names, or actual tar archive
-        # TODO: if tar archive exists, compute md5sum (instead of config param) and traverse to get filenames
-        self['settings']['analysisName'] = 'MTEWA1_{}_{}'.format(study_id.strip('EXR-MTEWA1'), datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d'))
+        self['settings']['analysisName'] = 'MTEWA1_{}_{}'.format(study_id.strip('EXR-MTEWA1') + ('_package{}'.format(package) if package else ''), datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d'))
         self['studyName'] = study_name
         self['userLogin'] = user_login
         self['md5CheckSum'] = md5sum
@@ -71,7 +438,7 @@ class Manifest(dict):
         self['runMetadataFileName'] = study_id + '-RU.metadata.tsv'
         self['submissionMetadataFileName'] = study_id + '-SU.metadata.tsv'
         self['studyMetadataFileName'] = study_id + '-ST.metadata.tsv'
-        if len(biosamples.dfs) == 1:
+        if len(sources) == 1:
             self['experimentMetadataFileName'] = study_id + '-EX.metadata.tsv'
             self['biosampleMetadataFileName'] = study_id + '-BS.metadata.tsv'
         else:
@@ -81,20 +448,19 @@ class Manifest(dict):
         self['manifest'] = list()
 
         # Fill in the samples to filenames map
-        with open(fastq_filenames, 'r') as file:
-            sample_filenames = {int(f.split('_')[0]): f.strip() for f in file}  # { MT.Unique.ID: fastq_filename }
-        for mt_unique_id in sorted(samples.df.index):  # only include fastq filenames in this study
-            fastq_filename = sample_filenames[mt_unique_id]
+        self.fastq_filenames = fastq_index.resolve(sample_sources)  # { MT.Unique.ID: fastq_filename } for the samples in this study
+        for mt_unique_id in sorted(self.fastq_filenames):
+            fastq_filename = self.fastq_filenames[mt_unique_id]
             sample_name = 'MT.Unique.ID_' + str(mt_unique_id)
-            sample_source = samples.df.loc[mt_unique_id, 'Source']
-            if len(biosamples.dfs) == 1:
+            sample_source = sample_sources[mt_unique_id]
+            if len(sources) == 1:
                 sample_dict = {'sampleName': sample_name, 'dataFileName': fastq_filename}
             else:
                 sample_dict = {'sampleName': sample_name, 'dataFileName': fastq_filename, 'biosampleMetadataFileName': study_id + sample_source + '-BS.metadata.tsv', 'experimentMetadataFileName': study_id + sample_source + '-EX.metadata.tsv'}
             self['manifest'].append(sample_dict)
 
-    def write(self):
-        with open(os.path.join(self.working_dir, self.study_id + '.manifest.json'), 'w') as file:
+    def write(self, output_filename=None):
+        with open(output_filename or os.path.join(self.working_dir, self.study_id + '.manifest.json'), 'w') as file:
             json.dump(self, file, indent=4, sort_keys=True)
 
     @property
@@ -113,11 +479,161 @@ class Manifest(dict):
         return sorted(list(filenames))
 
 
+class TarArchive:
+    def __init__(self, tar_filename, block_size=BLOCK_SIZE):
+        self.filename = tar_filename
+        self.block_size = block_size
+        self.sidecar_filename = tar_filename + '.md5.json'  # cached checksum & fastq filenames, keyed by archive size and mtime
+        self.future = None
+
+    def scan(self, background=False):
+        """ Compute the md5sum and list the fastq files of the archive, optionally on a background thread """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) if background else None
+        if executor:
+            self.future = executor.submit(self._scan)
+            executor.shutdown(wait=False)
+        else:
+            self.future = concurrent.futures.Future()
+            self.future.set_result(self._scan())
+
+    def result(self):
+        """ Return (md5sum, fastq_filenames), waiting for the scan to finish """
+        if not self.future:
+            self.scan()
+        return self.future.result()
+
+    def _scan(self):
+        stat = os.stat(self.filename)
+        if os.path.exists(self.sidecar_filename):
+            with open(self.sidecar_filename, 'r') as file:
+                sidecar = json.load(file)
+            if sidecar['size'] == stat.st_size and sidecar['mtime'] == stat.st_mtime:
+                return sidecar['md5sum'], sidecar['fastq_filenames']
+        # hash every byte while tarfile streams through the archive, so it's only read once
+        md5 = hashlib.md5()
+        with open(self.filename, 'rb') as file:
+            reader = HashingReader(file, md5)
+            with tarfile.open(fileobj=reader, mode='r|*', bufsize=self.block_size) as tar:
+                fastq_filenames = sorted(os.path.basename(member.name) for member in tar if member.isfile() and member.name.endswith(FASTQ_EXTENSIONS))
+            while reader.read(self.block_size):  # trailing padding after the end-of-archive marker
+                pass
+        md5sum = md5.hexdigest()
+        try:
+            with open(self.sidecar_filename, 'w') as file:
+                json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'md5sum': md5sum, 'fastq_filenames': fastq_filenames}, file)
+        except OSError:  # e.g. the archive is in a read-only directory
+            pass
+        return md5sum, fastq_filenames
+
+
+class FastqIndex(dict):
+    """ {MT.Unique.ID: {read: [fastq filenames]}} of the fastq files whose names match id_pattern, with the reads of paired-end samples grouped together """
+    def __init__(self, fastq_filenames=(), id_pattern=FASTQ_ID_PATTERN, read_pattern=FASTQ_READ_PATTERN):
+        super().__init__()
+        self.id_pattern = id_pattern
+        self.read_pattern = read_pattern
+        match_id, search_read = re.compile(id_pattern).match, re.compile(read_pattern).search
+        for fastq_filename in fastq_filenames:  # streamed, so a file of names is never held in memory as a list
+            fastq_filename = fastq_filename.strip()
+            basename = os.path.basename(fastq_filename)
+            sample_id = match_id(basename)
+            if not sample_id:  # not a sample's fastq file, e.g. another project's
+                continue
+            sample_id = int(sample_id.group(1)) if sample_id.group(1).isdigit() else sample_id.group(1)
+            read = search_read(basename)
+            names = self.setdefault(sample_id, dict()).setdefault(read.group(1) if read else '1', list())
+            if fastq_filename not in names:
+                names.append(fastq_filename)
+
+    @classmethod
+    def load(cls, source, id_pattern=FASTQ_ID_PATTERN, read_pattern=FASTQ_READ_PATTERN):
+        """ Index a list of fastq filenames, a file listing them one per line, or a directory of fastq files.
+        Indexes of files & directories are saved next to them in <source>.index.json and reused until they're modified or the patterns change.
+        """
+        if isinstance(source, FastqIndex):
+            return source
+        if isinstance(source, list):
+            return cls(source, id_pattern, read_pattern)
+        cache_filename = source.rstrip(os.sep) + '.index.json'
+        stat = os.stat(source)
+        key = {'size': None if os.path.isdir(source) else stat.st_size, 'mtime': stat.st_mtime, 'id_pattern': id_pattern, 'read_pattern': read_pattern}
+        if os.path.exists(cache_filename):
+            with open(cache_filename, 'r') as file:
+                cache = json.load(file)
+            if cache['key'] == key:
+                index = cls(id_pattern=id_pattern, read_pattern=read_pattern)
+                index.update((int(sample_id) if sample_id.isdigit() else sample_id, reads) for sample_id, reads in cache['index'].items())
+                return index
+        if os.path.isdir(source):
+            with os.scandir(source) as entries:
+                index = cls(sorted(entry.name for entry in entries if entry.name.endswith(FASTQ_EXTENSIONS) and entry.is_file()), id_pattern, read_pattern)
+        else:
+            with open(source, 'r') as file:
+                index = cls(file, id_pattern, read_pattern)
+        try:
+            with open(cache_filename, 'w') as file:
+                json.dump({'key': key, 'index': index}, file)
+        except OSError:  # e.g. the fastq files are in a read-only directory
+            pass
+        return index
+
+    def subset(self, sample_ids):
+        """ Index of just the given samples """
+        index = FastqIndex(id_pattern=self.id_pattern, read_pattern=self.read_pattern)
+        index.update((sample_id, self[sample_id]) for sample_id in sample_ids if sample_id in self)
+        return index
+
+    def resolve(self, sample_ids):
+        """ {sample id: fastq filename} for all the samples at once, using read 1 of paired-end samples.
+        Raises a ValueError listing every sample without a read 1 fastq file, or with several for the same read, so they can all be fixed before the next run.
+        """
+        fastq_filenames, problems, problem_samples = dict(), list(), set()
+        for sample_id in sorted(sample_ids):
+            reads = self.get(sample_id)
+            if not reads:
+                problem_samples.add(sample_id)
+                problems.append('MT.Unique.ID_{}\tno fastq file'.format(sample_id))
+                continue
+            if '1' not in reads:  # the manifest lists read 1, never its mate
+                problem_samples.add(sample_id)
+                problems.append('MT.Unique.ID_{}\tno read 1 fastq file, only: {}'.format(sample_id, ', '.join(sorted(name for names in reads.values() for name in names))))
+            for read, names in sorted(reads.items()):
+                if len(names) > 1:
+                    problem_samples.add(sample_id)
+                    problems.append('MT.Unique.ID_{}\t{} read {} fastq files: {}'.format(sample_id, len(names), read, ', '.join(sorted(names))))
+            if sample_id not in problem_samples:
+                fastq_filenames[sample_id] = reads['1'][0]
+        if problems:
+            raise ValueError('\n\t'.join(['{} sample(s) with a missing or duplicate fastq file:'.format(len(problem_samples))] + problems))
+        return fastq_filenames
+
+
+class HashingReader:
+    """ Read-only file wrapper that feeds everything read into a hash """
+    def __init__(self, file, hash):
+        self.file = file
+        self.hash = hash
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hash.update(data)
+        return data
+
+
+class HashingWriter:
+    """ Write-only file wrapper that feeds everything written into a hash """
+    def __init__(self, file, hash):
+        self.file = file
+        self.hash = hash
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+
 class MetaDataFrame:
-    def __init__(self, csv_filename=None, dataframe=None):
-        if csv_filename:
-            self.df = pd.read_csv(csv_filename, sep='\t' if csv_filename.endswith('.tsv') else ',')
-        elif type(dataframe) == pd.DataFrame:
+    def __init__(self, dataframe=None):
+        if type(dataframe) == pd.DataFrame:
             self.df = dataframe.copy()
         else:
             self.df = pd.DataFrame()
@@ -126,12 +642,78 @@ class MetaDataFrame:
         self.df.to_csv(output_filename, sep='\t', index=True)
 
 
+class Table:
+    """ A light stand-in for a dataframe when pandas isn't needed: column names, one list of values per row, and an index """
+    def __init__(self, columns, rows, index=None, index_name=None):
+        self.columns = columns
+        self.rows = rows
+        self.index = index if index is not None else list(range(len(rows)))
+        self.index_name = index_name
+
+    def records(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+    def write(self, output_filename):
+        """ Write the table the same way MetaDataFrame.write does, with missing values left blank """
+        with open(output_filename, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.writer(file, delimiter='\t', lineterminator=os.linesep)
+            writer.writerow([self.index_name or ''] + self.columns)
+            for label, row in zip(self.index, self.rows):
+                writer.writerow([label] + row)
+
+
+class SampleSheet(MetaDataFrame):
+    def __init__(self, samples_filename, sample_study_names, cache_dir=None, dataframe=None):
+        if dataframe is not None:  # select the studies from a sample sheet that's already loaded
+            super().__init__(dataframe=dataframe.loc[dataframe['Study'].isin(sample_study_names)])
+            for column in CATEGORICAL_COLUMNS:
+                self.df[column] = self.df[column].cat.remove_unused_categories()
+            return
+        # Load only the samples in the given studies that passed quality control
+        cache_filename = os.path.join(cache_dir, 'sample_sheet.{}.pkl'.format(self.cache_key(samples_filename, sample_study_names))) if cache_dir else None
+        if cache_filename and os.path.exists(cache_filename):
+            super().__init__(dataframe=pd.read_pickle(cache_filename))
+            return
+        super().__init__()
+        chunks = list()
+        chunk_dtypes = {column: list() for column in SAMPLE_SHEET_COLUMNS if column not in CATEGORICAL_COLUMNS}
+        reader = pd.read_csv(samples_filename, sep='\t' if samples_filename.endswith('.tsv') else ',', usecols=SAMPLE_SHEET_COLUMNS,
+                             dtype={column: 'category' for column in CATEGORICAL_COLUMNS}, chunksize=CHUNK_SIZE)
+        for chunk in reader:
+            for column, dtypes in chunk_dtypes.items():
+                dtypes.append(chunk[column].dtype)
+            chunks.append(chunk.loc[(chunk['Study'].isin(sample_study_names)) & (chunk['MISEQ.QC.PASS'] == 'PASS')])
+        self.df = pd.concat(chunks)
+        # use the dtypes pandas would have inferred from the whole sheet, e.g. ages are floats if any chunk has a missing age,
+        # and IDs are text if any chunk has one that isn't a number
+        text_columns = list()
+        for column, dtypes in chunk_dtypes.items():
+            if all(pd.api.types.is_numeric_dtype(dtype) for dtype in dtypes):
+                self.df[column] = self.df[column].astype(np.result_type(*dtypes))
+            elif len(set(dtypes)) > 1:
+                text_columns.append(column)
+        if text_columns:  # the numbers in the other chunks were already parsed, so read those columns again as text
+            reader = pd.read_csv(samples_filename, sep='\t' if samples_filename.endswith('.tsv') else ',', usecols=text_columns + ['Study', 'MISEQ.QC.PASS'], dtype=str, chunksize=CHUNK_SIZE)
+            text = pd.concat([chunk.loc[(chunk['Study'].isin(sample_study_names)) & (chunk['MISEQ.QC.PASS'] == 'PASS'), text_columns] for chunk in reader])
+            for column in text_columns:
+                self.df[column] = text[column]
+        for column in CATEGORICAL_COLUMNS:
+            self.df[column] = self.df[column].astype(object).astype('category')
+        if cache_filename:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            self.df.to_pickle(cache_filename)
+
+    @staticmethod
+    def cache_key(samples_filename, sample_study_names):
+        key = hashlib.md5(file_md5(samples_filename).encode())
+        key.update(repr((sorted(sample_study_names), SAMPLE_SHEET_COLUMNS)).encode())
+        return key.hexdigest()
+
+
 class Samples(MetaDataFrame):
-    def __init__(self, samples_filename, sample_study_names, is_time_series):
-        super().__init__(csv_filename=samples_filename)
-        # Load the samples spreadsheet
-        # only use healthy control study and samples that passed quality control
-        self.df = self.df.loc[(self.df['Study'].isin(sample_study_names)) & (self.df['MISEQ.QC.PASS'] == 'PASS')]
+    def __init__(self, sample_sheet, is_time_series):
+        super().__init__(dataframe=sample_sheet)
         # keep only the necessary columns
         self.df = self.df[['Participant.ID', 'Sample.ID', 'MT.Unique.ID', 'Source', 'Study']]
         self.df = self.df.set_index(['MT.Unique.ID']).sort_values(by='Participant.ID')
@@ -141,201 +723,790 @@ class Samples(MetaDataFrame):
 
 
 class Participants(MetaDataFrame):
-    def __init__(self, samples_filename, sample_study_names, is_time_series):
-        super().__init__(csv_filename=samples_filename)
-        # only use healthy control study and samples that passed quality control
-        self.df = self.df.loc[(self.df['Study'].isin(sample_study_names)) & (self.df['MISEQ.QC.PASS'] == 'PASS')]
-        self.df["Source"] = self.df["Source"].str.capitalize()
+    def __init__(self, sample_sheet, is_time_series, ontology_filename):
+        super().__init__(dataframe=self.select(sample_sheet, is_time_series))
+
+        # Use correct ontology terms
+        self.unmatched = Ontology(ontology_filename).normalize(self.df)
+        Ontology.print_unmatched(self.unmatched)
+
+    @staticmethod
+    def select(sample_sheet, is_time_series):
+        """ The sample sheet row of each participant, indexed by Participant.ID """
+        df = sample_sheet.copy()
+        df["Source"] = df["Source"].str.capitalize()
         # remove duplicate participants -- all have plasma but some additionally have serum  TODO: make this more general to work with other study designs
-        self.df = self.df.loc[(self.df['Source'] == 'Plasma')]
+        df = df.loc[(df['Source'] == 'Plasma')]
         if is_time_series:
-            self.df['timepoint'] = pd.Series([sample_id.split('-')[1] if len(sample_id.split('-')) > 1 else 'T0' for sample_id in self.df['Sample.ID']], index=self.df.index)
-            self.df['timestep'] = pd.Series([study.split('-')[1] if len(study.split('-')) > 1 else 'NA' for study in self.df['Study']], index=self.df.index)
-            self.df = self.df.loc[(self.df['timepoint'] == 'T0')]
-        self.df = self.df[['Participant.ID', 'Age', 'Race', 'Gender']].set_index('Participant.ID')
+            df['timepoint'] = pd.Series([sample_id.split('-')[1] if len(sample_id.split('-')) > 1 else 'T0' for sample_id in df['Sample.ID']], index=df.index)
+            df['timestep'] = pd.Series([study.split('-')[1] if len(study.split('-')) > 1 else 'NA' for study in df['Study']], index=df.index)
+            df = df.loc[(df['timepoint'] == 'T0')]
+        return df[['Participant.ID', 'Age', 'Race', 'Gender']].set_index('Participant.ID')
 
-        # Use correct ontology terms
-        # TODO: make this more generic. change given terms to lowercase and check if individual words (split by spaces and other symbols) match any keys.
-        race_ontology = {'Asian': 'Asian', 'asian': 'Asian',
-                         'Black or African American': 'African American',
-                         'mixed/asian & white': 'Multiracial',
-                         'mixed/Asian &Black': 'Multiracial',
-                         'mixed/black, white, asian': 'Multiracial',
-                         'Native Hawiian or other Pacific Islander': 'Native Hawaiian or Other Pacific Islander',
-                         'Pacific Islander': 'Native Hawaiian or Other Pacific Islander',
-                         'White': 'White', 'white': 'White',
-                         np.nan: MISSING}
-        for index in self.df.index:
-            race = self.df.at[index, 'Race']
-            self.df.loc[index, 'Race'] = race_ontology[race] if race in race_ontology else 'Multiracial'
-            age = self.df.at[index, 'Age']
-            if not (0 <= age <= 130):
-                self.df.loc[index, 'Age'] = MISSING
-            gender = self.df.loc[index, 'Gender']
-            if type(gender) == float:
-                self.df.loc[index, 'Gender'] = MISSING
-            elif gender != MISSING:
-                self.df.loc[index, 'Gender'] = gender.capitalize()
+
+class Ontology(dict):
+    """ Rules for normalizing sample sheet columns to ontology terms, loaded from a yaml file (see templates/ontology.yaml) """
+    def __init__(self, ontology_filename):
+        with open(ontology_filename, 'r') as file:
+            super().__init__(yaml.safe_load(file))
+
+    def normalize(self, df):
+        """ Normalize the columns of df in place and return {column: {unmatched value: count}} """
+        unmatched = dict()
+        for column, rules in self.items():
+            if column not in df.columns:
+                continue
+            df[column], unmatched_values = self.normalize_column(df[column], rules)
+            if len(unmatched_values):
+                unmatched[column] = unmatched_values
+        return unmatched
+
+    @staticmethod
+    def normalize_column(column, rules):
+        missing = rules.get('missing', MISSING)
+        present = column.notnull()
+        if 'range' in rules:
+            numbers = pd.to_numeric(column, errors='coerce')
+            in_range = numbers.between(*rules['range'])
+            return column.where(in_range, missing), column[present & ~in_range].value_counts()
+        # match each distinct value once, then map the whole column
+        values = pd.Series(column[present].unique())
+        values.index = values
+        lowered = values.astype(str).str.strip().str.lower()
+        terms = lowered.map({term.lower(): value for term, value in rules.get('terms', dict()).items()})
+        words = lowered[terms.isnull()].str.findall(r'[a-z0-9]+').explode()
+        word_terms = words.map({token.lower(): value for token, value in rules.get('tokens', dict()).items()}).dropna().groupby(level=0)
+        terms = terms.fillna(word_terms.first().where(word_terms.nunique() == 1, rules.get('multiple')))
+        unmatched_values = terms.index[terms.isnull()]
+        terms = terms.fillna(rules['unmatched']) if 'unmatched' in rules else terms.fillna(values)
+        return column.map(terms).where(present, missing), column[column.isin(unmatched_values)].value_counts()
+
+    def normalize_records(self, records):
+        """ normalize() for a list of {column: value} dicts, without pandas """
+        unmatched = dict()
+        for column, rules in self.items():
+            if not records or column not in records[0]:
+                continue
+            matches = dict()  # match each distinct value once
+            counts = collections.Counter()
+            for record in records:
+                value = record[column]
+                if value not in matches:
+                    matches[value] = self.match_value(value, rules)
+                record[column], matched = matches[value]
+                if not matched:
+                    counts[value] += 1
+            if counts:
+                unmatched[column] = dict(counts.most_common())
+        return unmatched
+
+    @staticmethod
+    def match_value(value, rules):
+        """ The normalized value and whether it matched the rules, for a single value the way normalize_column does it """
+        missing = rules.get('missing', MISSING)
+        if value is None:
+            return missing, True
+        if 'range' in rules:
+            try:
+                number = float(value)
+            except ValueError:
+                number = None
+            in_range = number is not None and rules['range'][0] <= number <= rules['range'][1]
+            return value if in_range else missing, in_range
+        lowered = str(value).strip().lower()
+        terms = {term.lower(): term_value for term, term_value in rules.get('terms', dict()).items()}
+        if terms.get(lowered) is not None:
+            return terms[lowered], True
+        tokens = {token.lower(): token_value for token, token_value in rules.get('tokens', dict()).items()}
+        word_terms = {tokens[word] for word in re.findall(r'[a-z0-9]+', lowered) if tokens.get(word) is not None}
+        if len(word_terms) == 1:
+            return word_terms.pop(), True
+        if len(word_terms) > 1 and rules.get('multiple') is not None:
+            return rules['multiple'], True
+        return rules.get('unmatched', value), False
+
+    @staticmethod
+    def print_unmatched(unmatched):
+        if unmatched:  # printed at once so packages prepared in parallel don't interleave their lines
+            print('\n\t'.join(['Values not found in the ontology:'] + ['{}: {}'.format(column, ', '.join('{!r} ({})'.format(value, count) for value, count in values.items())) for column, values in unmatched.items()]))
 
 
 class Donors(MetaDataFrame):
-    def __init__(self, templates_dir, participants, study_id, is_time_series):
+    def __init__(self, templates_dir, participants, study_id, is_time_series, cache_dir=None):
         # Load the donors template
-        super().__init__(csv_filename=os.path.join(templates_dir, 'Donors.template.tsv'))
-        self.df = self.df.set_index('#property')
-        self.df.drop(['- Ethnic Group', '-- Current Health Status', '-- Medical History', '-- Smoking History', '-- Medications', '-- Treatment History',
-                      '-- Family History', '-- Treatment History', '-- Family History', '-- Developmental Stage', '- Has Expired?', '-- Estimated Date',
-                      '-- Post-mortem Interval', '- Notes', '* Family Members', '*- Family Member', '*-- Relationship', '*-- DocURL', '* Aliases', '*-  Accession',
-                      '*-- dbName', '*-- URL', '- Health Status', '*-- Notes'], inplace=True)
-        genders = {'Male', 'Female'}
-        # Fill in the donors dataframe
-        for index, part_id in enumerate(participants.index):
-            participant_column = 'value' + part_id
-            donor_id = study_id + str(index + 1) + '-DO'
-            participants.loc[part_id, 'donor.id'] = donor_id
-            self.df.insert(index + 1, participant_column, self.df['value'])
-            self.df.loc['Donor', participant_column] = donor_id  # for matching biosamples to donor ids
-            self.df.loc['- Status', participant_column] = 'Protect' if is_time_series else 'Add'
-            gender = participants.at[part_id, 'Gender']
-            self.df.loc['- Sex', participant_column] = gender if gender in genders else '#MISSING#'
-            self.df.loc['- Racial Category', participant_column] = participants.at[part_id, 'Race']
-            self.df.loc['- Donor Type', participant_column] = 'Healthy Subject' if not is_time_series else 'Experimental'
-            age = str(participants.at[part_id, 'Age'])
-            self.df.loc['- Age', participant_column] = age + ' years' if age != '#MISSING#' else age
-            self.df.loc['* Custom Metadata', participant_column] = 1
-            self.df.loc['*- Property Name', participant_column] = 'Participant.ID'
-            self.df.loc['*-- Value', participant_column] = part_id
-        self.df = self.df.drop('value', axis=1)
-        self.df.columns = [''.join(l for l in col if not l.isdigit() and l != '*') for col in list(self.df.columns)]
-        self.df.index = pd.Index([''.join(l for l in col if not l.isdigit()) for col in list(self.df.index)], name=self.df.index.name)
+        super().__init__(dataframe=compile_template(templates_dir, 'Donors', is_time_series, cache_dir=cache_dir))
+        # Fill in the donors dataframe, one value column per participant
+        if 'donor.id' not in participants.columns:
+            assign_donor_ids(participants, study_id)
+        fields = donor_fields(is_time_series, participants['donor.id'].tolist(), participants.index.tolist(), participants['Gender'].tolist(), participants['Race'].tolist(), participants['Age'].tolist())
+        self.df = fill_template(self.df, ['value' + part_id for part_id in participants.index], fields)
 
 
 class Biosamples:
-    def __init__(self, study_id, templates_dir, working_dir, participants, samples, is_time_series):
-        self.filename_base = os.path.join(working_dir, study_id)
-        self.filename_ext = '-BS.metadata.tsv'
-
-        timepoints = {"1 hr": {"T0": 'Fasting blood draw',
-                               "T1": "1 hr post meal 1",
-                               "T2": "2 hrs post meal 1",
-                               "T3": "3 hrs post meal 1",
-                               "T4": "4 hrs post meal 1",
-                               "T5": "1 hr post meal 2",
-                               "T6": "2 hrs post meal 2",
-                               "T7": "3 hrs post meal 2",
-                               "T8": "4 hrs post meal 2",
-                               "T9": "24 hrs post meal 2",
-                               "T10": "48 hrs post meal 2"},
-                      "30 min": {"T0": 'Fasting blood draw',
-                                 "T1": "0.5 hr post meal 1",
-                                 "T2": "1 hr post meal 1",
-                                 "T3": "1.5 hrs post meal 1",
-                                 "T4": "2 hrs post meal 1",
-                                 "T5": "2.5 hrs post meal 1",
-                                 "T6": "3 hrs post meal 1",
-                                 "T7": "3.5 hrs post meal 1",
-                                 "T8": "4 hrs post meal 1",
-                                 "T9": "24 hrs post meal 2",
-                                 "T10": "48 hrs post meal 2"}}
-
-        # load the template and clean it up
-        template = MetaDataFrame(csv_filename=os.path.join(templates_dir, 'Biosamples.template.tsv'))
-        template.df = template.df.set_index('#property')
-        template.df = template.df.drop(['-- Age at Sampling', '-- Notes', '- Description', '--- Symptoms', '--- Pathology', '--- Disease Duration',
-                                        '--- Collection Details',
-                                        '---- Sample Collection Method', '---- Geographic Location',
-                                        '---- Collection Date', '---- Time of Collection',
-                                        '---- Collection Tube Type', '----- Other Collection Tube Type',
-                                        '---- Holding Time', '---- Holding Temperature',
-                                        '---- Preservatives Used', '---- Freezing Method',
-                                        '---- Number of Times Freeze Thawed',
-                                        '---- Contamination Removal Method', '--- Notes',
-                                        '-- Cell Culture Supernatant', '--- Source', '---- Type',
-                                        '---- Cell Line', '---- Start Date', '---- Harvest Date', '--- Tissue',
-                                        '---- Date Obtained', '---- Tissue Type', '--- Notes',
-                                        '-- Starting Amount', '-- Replicate Information',
-                                        '--- Biological Replicate Number', '--- Technical Replicate Number', '-- Provider', '--- Company Name', '--- Lab Name', '--- Person Name',
-                                        '* Pooled Biosamples', '*- Pooled Biosample', '*-- DocURL', '* Aliases', '*-  Accession', '*-- dbName', '*-- URL',
-                                        '*-- Date Submitted to External Database', '*-- Notes'])
-        template.df = template.df.T
-        template.df.insert(18, '*-- DocURL', [np.nan, 'URL', np.nan, np.nan, 'Relative ID (accession) of doc, provide Document URL'])
-        if is_time_series:
-            template.df.insert(23, '*- Property Name2', template.df['*- Property Name'])
-            template.df.insert(24, '*-- Value2', template.df['*-- Value'])
-            template.df.insert(25, '*- Property Name3', template.df['*- Property Name'])
-            template.df.insert(26, '*-- Value3', template.df['*-- Value'])
-            template.df.insert(27, '*- Property Name4', template.df['*- Property Name'])
-            template.df.insert(28, '*-- Value4', template.df['*-- Value'])
-        template.df = template.df.T
-
-        sources = set(samples['Source'])
+    def __init__(self, study_id, templates_dir, participants, samples, is_time_series, sources=None, cache_dir=None, biosample_ids=None):
+        # load the template, already cleaned up
+        template = MetaDataFrame(dataframe=compile_template(templates_dir, 'Biosamples', is_time_series, cache_dir=cache_dir))
+
         self.dfs = dict()  # one dataframe per source
-        for source in sources:
-            self.dfs[source] = MetaDataFrame(dataframe=template.df)
-        start_column_length = len(template.df.columns)
-        for mt_unique_id in sorted(samples.index):  # Fill in the biosamples dataframes
-            donor_id = participants.loc[samples.loc[mt_unique_id, 'Participant.ID'], 'donor.id']
-            sample_column = 'value' + str(mt_unique_id)
-            sample_source = samples.loc[mt_unique_id, 'Source']
-            index = len(self.dfs[sample_source].df.columns) - start_column_length + 1
-            self.dfs[sample_source].df.insert(index, sample_column, self.dfs[sample_source].df['value'])
-            self.dfs[sample_source].df.loc['Biosample', sample_column] = study_id + str(index) + '-BS'
-            self.dfs[sample_source].df.loc['- Status', sample_column] = 'Protect' if is_time_series else 'Add'
-            self.dfs[sample_source].df.loc['- Name', sample_column] = 'MT.Unique.ID_' + str(mt_unique_id)
-            self.dfs[sample_source].df.loc['- Donor ID', sample_column] = donor_id
-            self.dfs[sample_source].df.loc['-- DocURL', sample_column] = 'coll/Donors/doc/' + donor_id
-            self.dfs[sample_source].df.loc['--- Scientific Name', sample_column] = 'Homo sapiens'
-            self.dfs[sample_source].df.loc['--- Common Name', sample_column] = 'Human'
-            self.dfs[sample_source].df.loc['--- Taxon ID', sample_column] = 9606
-            self.dfs[sample_source].df.loc['-- Disease Type', sample_column] = 'Healthy Subject'
-            self.dfs[sample_source].df.loc['-- Anatomical Location', sample_column] = 'Plasma cell'
-            self.dfs[sample_source].df.loc['--- Biofluid Name', sample_column] = sample_source
-            self.dfs[sample_source].df.loc['-- exRNA Source', sample_column] = ' total cell-free biofluid RNA'
-            self.dfs[sample_source].df.loc['-- Fractionation', sample_column] = 'Yes'
-            self.dfs[sample_source].df.loc['* Related Experiments', sample_column] = 1
-            self.dfs[sample_source].df.loc['*- Related Experiment', sample_column] = study_id + '1-EX'
-            self.dfs[sample_source].df.loc['*-- DocURL', sample_column] = 'coll/Experiments/doc/' + study_id + '1-EX'
-            self.dfs[sample_source].df.loc['* Custom Metadata', sample_column] = 4 if is_time_series else 1
-            self.dfs[sample_source].df.loc['*- Property Name', sample_column] = 'Participant.ID'
-            self.dfs[sample_source].df.loc['*-- Value', sample_column] = samples.loc[mt_unique_id, 'Participant.ID']
-            if is_time_series:
-                self.dfs[sample_source].df.loc['*- Property Name2', sample_column] = 'timepoint_id'
-                timepoint_id = samples.loc[mt_unique_id, 'timepoint']
-                self.dfs[sample_source].df.loc['*-- Value2', sample_column] = timepoint_id
-                self.dfs[sample_source].df.loc['*- Property Name3', sample_column] = 'timepoint_description'
-                time_between_collections = samples.loc[mt_unique_id, 'timestep']
-                self.dfs[sample_source].df.loc['*-- Value3', sample_column] = timepoints[time_between_collections][timepoint_id]
-                self.dfs[sample_source].df.loc['*- Property Name4', sample_column] = 'time_between_sample_collections_0-8'
-                self.dfs[sample_source].df.loc['*-- Value4', sample_column] = time_between_collections
-
-        for key in self.dfs:  # drop the empty "value" column and rename all numbered value columns to just "value"
-            self.dfs[key].df = self.dfs[key].df.drop('value', axis=1)
-            self.dfs[key].df.columns = [''.join(l for l in col if not l.isdigit() and l != '*') for col in list(self.dfs[key].df.columns)]
-            self.dfs[key].df.index = pd.Index([''.join(l for l in col if not l.isdigit()) for col in list(self.dfs[key].df.index)], name=self.dfs[key].df.index.name)
-
-        if len(self.dfs) == 1:  # reassign the lone dataframe to an empty string dict key
-            self.dfs[''] = self.dfs.pop(set(self.dfs.keys()).pop())
+        for source, source_samples in samples.sort_index().groupby('Source', sort=False, observed=True):  # Fill in the biosamples dataframes
+            if sources is not None and source not in sources:  # only build these sources
+                continue
+            fields = biosample_fields(study_id, is_time_series, source, source_samples.index.tolist(), source_samples['Participant.ID'].tolist(), participants.loc[source_samples['Participant.ID'], 'donor.id'].tolist(),
+                                      source_samples['timepoint'].tolist() if is_time_series else None, source_samples['timestep'].tolist() if is_time_series else None,
+                                      [biosample_ids[mt_unique_id] for mt_unique_id in source_samples.index] if biosample_ids else None)
+            self.dfs[source] = MetaDataFrame(dataframe=fill_template(template.df, ['value' + str(mt_unique_id) for mt_unique_id in source_samples.index], fields))
+
+    @staticmethod
+    def filenames(study_id, working_dir, sources):
+        """ {source: output filename}, without the source in the filename if there's only one """
+        return {source: os.path.join(working_dir, study_id + (source if len(sources) > 1 else '') + '-BS.metadata.tsv') for source in sources}
+
+
+class BuildState(dict):
+    """ Hashes of the inputs each output file was last built from, saved in working_dir """
+    def __init__(self, state_filename):
+        self.filename = state_filename  # no state is kept when None, so everything is rebuilt
+        if state_filename and os.path.exists(state_filename):
+            with open(state_filename, 'r') as file:
+                super().__init__(json.load(file))
+
+    def is_current(self, output_filename, inputs):
+        return self.filename is not None and self.get(os.path.basename(output_filename)) == inputs and os.path.exists(output_filename)
+
+    def update(self, output_filename, inputs):
+        self[os.path.basename(output_filename)] = inputs
+
+    def remove(self, keep=()):
+        """ Delete the outputs built earlier, other than the keep basenames, and forget them. Returns the removed filenames """
+        removed = list()
+        for basename in sorted(set(self) - set(keep)):
+            output_filename = os.path.join(os.path.dirname(self.filename), basename)
+            if os.path.exists(output_filename):
+                os.remove(output_filename)
+                removed.append(output_filename)
+            del self[basename]
+        return removed
 
     def write(self):
-        for source, df in self.dfs.items():
-            df.write(self.filename_base + source + self.filename_ext)
+        if self.filename:
+            with open(self.filename, 'w') as file:
+                json.dump(self, file, indent=4, sort_keys=True)
+
+
+class Validator(list):
+    """ Checks compiled once from a template's domain & required columns, as one (property, domain, required, check) per row (see compile_check) """
+    def __init__(self, template):
+        super().__init__()
+        self.n_template_columns = len(template.columns) - 1  # columns after the records' values in a filled document
+        domains, requireds = [[row[template.columns.index(column)] for row in template.rows] for column in ('domain', 'required')]
+        for prop, domain, required in zip(template.index, domains, requireds):
+            domain = str(domain).strip() if domain is not None else 'string'
+            self.append((prop, domain, (required is True or str(required).strip().upper() == 'TRUE') and domain != '[valueless]', compile_check(domain)))
+
+    def validate(self, document):
+        """ Problems in a document filled from the template, as [{property, domain, value, count, error}] with each distinct bad value once """
+        problems = list()
+        for (prop, domain, required, check), (values, counts) in zip(self, value_counts(document, self.n_template_columns)):
+            if not isinstance(values, list):  # run the checks on all of a row's values at once, then only look closer at the ones that failed
+                values, counts = suspect_values(values, counts, domain, check)
+            row_problems = list()
+            for value, count in zip(values, counts):
+                missing = value is None or value != value or str(value).strip() == ''
+                if missing or value == MISSING:
+                    error = 'required value missing' if required else (None if missing else 'missing value')
+                else:
+                    error = check_value(check, value) or ('duplicate ID' if domain.startswith('autoID') and count > 1 else None)
+                if error:
+                    row_problems.append({'property': strip_digits(prop), 'domain': domain, 'value': None if missing else value, 'count': count, 'error': error})
+            problems.extend(sorted(row_problems, key=lambda problem: (-problem['count'], str(problem['value']))))
+        return problems
+
+
+class ValidationReport(dict):
+    """ Problems found validating each output file, saved as json in working_dir so files that weren't rebuilt keep theirs """
+    def __init__(self, report_filename):
+        self.filename = report_filename  # nothing is saved when None
+        if report_filename and os.path.exists(report_filename):
+            with open(report_filename, 'r') as file:
+                super().__init__(json.load(file))
+
+    def count(self):
+        return sum(len(problems) for problems in self.values())
+
+    def print_problems(self):
+        if self.count():
+            print('\n\t'.join(['Found {} problem(s) validating the documents, saved to {}:'.format(self.count(), self.filename)] +
+                                ['{}\t{}\t{!r} ({})\t{}'.format(filename, problem['property'], problem['value'], problem['count'], problem['error']) for filename, problems in sorted(self.items()) for problem in problems]))
+
+    def write(self):
+        if self.filename:
+            with open(self.filename, 'w') as file:
+                json.dump(self, file, indent=4, sort_keys=True)
+
+
+class RunReport(dict):
+    """ Wall time, cpu time, peak memory and output size of each stage of a submission, saved as json """
+    def __init__(self, report_filename=None, profile_filename=None):
+        super().__init__(stages=list())
+        self.filename = report_filename  # stages aren't measured when None
+        self.profile_filename = profile_filename
+        self.profiler = cProfile.Profile() if profile_filename else None
+        self.started = None
+
+    @contextlib.contextmanager
+    def run(self, study_id):
+        """ Measure a whole submission. The profiler is stopped even if the submission fails, so the next study in a batch worker isn't profiled """
+        self.update(study_id=study_id, date=datetime.datetime.now().isoformat(), python=platform.python_version())
+        self.started = (time.perf_counter(), time.process_time())
+        if self.profiler:
+            self.profiler.enable()
+        try:
+            yield self
+        finally:
+            if self.profiler:
+                self.profiler.disable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Measure a stage's wall & cpu time, the resident memory of the process when it starts, and the peak resident memory by its end with how much
+        the stage raised it, which is 0 for stages that stayed below the peak of earlier stages or, in a batch worker, earlier studies.
+        Tracing memory would slow the stages down, so peak_memory_bytes, the stage's own peak of the memory python allocated,
+        is only added when the caller is tracing with tracemalloc, like benchmark.py
+        """
+        stage = {'name': name}
+        if not self.filename:
+            yield stage
+            return
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        stage['rss_start_bytes'], start_max_rss = rss(), max_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        yield stage
+        stage.update(wall_seconds=time.perf_counter() - wall, cpu_seconds=time.process_time() - cpu, max_rss_bytes=max_rss())
+        stage['max_rss_delta_bytes'] = stage['max_rss_bytes'] - start_max_rss if start_max_rss is not None else None
+        if tracing:
+            stage['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        self['stages'].append(stage)
+
+    @staticmethod
+    def count(stage, *dfs):
+        dfs = [df.df if isinstance(df, MetaDataFrame) else df for df in dfs]  # dataframes, MetaDataFrames or Tables
+        stage['rows'] = sum(len(df.index) for df in dfs)
+        stage['columns'] = sum(len(df.columns) for df in dfs)
+
+    def finish(self, **details):
+        if self.profiler:
+            self.profiler.dump_stats(self.profile_filename)
+        if self.filename:
+            self.update(details, pandas=sys.modules['pandas'].__version__ if 'pandas' in sys.modules else None, wall_seconds=time.perf_counter() - self.started[0], cpu_seconds=time.process_time() - self.started[1])
+            with open(self.filename, 'w') as file:
+                json.dump(self, file, indent=4)
+
+
+def donor_fields(is_time_series, donor_ids, participant_ids, genders, races, ages):
+    """ Values of each property of the Donors document, as one value per participant or one for all of them """
+    ages = [str(age) for age in ages]
+    return {'Donor': donor_ids,
+            '- Status': 'Protect' if is_time_series else 'Add',
+            '- Sex': [gender if gender in {'Male', 'Female'} else MISSING for gender in genders],
+            '- Racial Category': races,
+            '- Donor Type': 'Healthy Subject' if not is_time_series else 'Experimental',
+            '- Age': [age if age == MISSING else age + ' years' for age in ages],
+            '* Custom Metadata': 1,
+            '*- Property Name': 'Participant.ID',
+            '*-- Value': participant_ids}
+
+
+def biosample_fields(study_id, is_time_series, source, mt_unique_ids, participant_ids, donor_ids, timepoint_ids=None, timesteps=None, biosample_ids=None):
+    """ Values of each property of a Biosamples document, as one value per sample or one for all of them.
+    Biosamples are numbered in order unless their biosample_ids are given
+    """
+    fields = {'Biosample': biosample_ids or [study_id + str(index + 1) + '-BS' for index in range(len(mt_unique_ids))],
+              '- Status': 'Protect' if is_time_series else 'Add',
+              '- Name': ['MT.Unique.ID_' + str(mt_unique_id) for mt_unique_id in mt_unique_ids],
+              '- Donor ID': donor_ids,
+              '-- DocURL': ['coll/Donors/doc/' + donor_id for donor_id in donor_ids],
+              '--- Scientific Name': 'Homo sapiens',
+              '--- Common Name': 'Human',
+              '--- Taxon ID': 9606,
+              '-- Disease Type': 'Healthy Subject',
+              '-- Anatomical Location': 'Plasma cell',
+              '--- Biofluid Name': source,
+              '-- exRNA Source': ' total cell-free biofluid RNA',
+              '-- Fractionation': 'Yes',
+              '* Related Experiments': 1,
+              '*- Related Experiment': study_id + '1-EX',
+              '*-- DocURL': 'coll/Experiments/doc/' + study_id + '1-EX',
+              '* Custom Metadata': 4 if is_time_series else 1,
+              '*- Property Name': 'Participant.ID',
+              '*-- Value': participant_ids}
+    if is_time_series:
+        fields.update({'*- Property Name2': 'timepoint_id',
+                       '*-- Value2': timepoint_ids,
+                       '*- Property Name3': 'timepoint_description',
+                       '*-- Value3': [TIMEPOINTS[time_between_collections][timepoint_id] for timepoint_id, time_between_collections in zip(timepoint_ids, timesteps)],
+                       '*- Property Name4': 'time_between_sample_collections_0-8',
+                       '*-- Value4': timesteps})
+    return fields
+
+
+def assign_donor_ids(participants, study_id, donor_ids=None):
+    """ Number the donors in order, or look up their ids in {Participant.ID: donor id} when they were numbered across a whole study """
+    if donor_ids:
+        participants['donor.id'] = [donor_ids[part_id] for part_id in participants.index]
+    else:
+        participants['donor.id'] = [study_id + str(index + 1) + '-DO' for index in range(len(participants.index))]  # for matching biosamples to donor ids
+
+
+def study_ids(sample_sheet, study_id, is_time_series):
+    """ ({Participant.ID: donor id}, {MT.Unique.ID: biosample id}) numbered across a whole study the way a single submission numbers them """
+    participant_ids = Participants.select(sample_sheet, is_time_series).index
+    donor_ids = {part_id: study_id + str(index + 1) + '-DO' for index, part_id in enumerate(participant_ids)}
+    biosample_ids = dict()
+    for source, source_samples in Samples(sample_sheet, is_time_series).df.sort_index().groupby('Source', sort=False, observed=True):
+        biosample_ids.update({mt_unique_id: study_id + str(index + 1) + '-BS' for index, mt_unique_id in enumerate(source_samples.index)})
+    return donor_ids, biosample_ids
+
+
+def split_packages(sample_sheet, max_samples):
+    """ Participant.IDs of each package, adding participants in sample sheet order while their samples fit.
+    A participant with more than max_samples samples gets a package of their own that is bigger than max_samples
+    """
+    packages = [[]]
+    package_samples = 0
+    for part_id, samples in sample_sheet.groupby('Participant.ID', sort=False).size().items():
+        if packages[-1] and package_samples + samples > max_samples:
+            packages.append(list())
+            package_samples = 0
+        packages[-1].append(part_id)
+        package_samples += samples
+    return packages
+
+
+def write_package_archives(archive_fastq_filenames, tar_archive=None, fastq_dir=None, block_size=BLOCK_SIZE):
+    """ Write a tar archive of each package's fastq files, so each package can be uploaded on its own with the md5sum of its own archive.
+    archive_fastq_filenames: {archive filename: names of the fastq files to put in it}, taken from tar_archive in one pass over it, or from fastq_dir.
+    The md5sum is computed while each archive is written and saved next to it like TarArchive's, and archives are only rewritten when their fastq files
+    or the archive or files they come from change. Returns ({archive filename: md5sum}, the filenames of the archives written)
+    """
+    def source_key(fastq_filenames):
+        sources = [tar_archive] if tar_archive else [os.path.join(fastq_dir, fastq_filename) for fastq_filename in sorted(fastq_filenames)]
+        return hash_inputs([(source, os.stat(source).st_size, os.stat(source).st_mtime) for source in sources])
+
+    md5sums, stale = dict(), dict()
+    for archive_filename, fastq_filenames in archive_fastq_filenames.items():
+        sidecar_filename = archive_filename + '.md5.json'
+        if os.path.exists(archive_filename) and os.path.exists(sidecar_filename):
+            with open(sidecar_filename, 'r') as file:
+                sidecar = json.load(file)
+            stat = os.stat(archive_filename)
+            if (sidecar['size'], sidecar['mtime'], sidecar.get('source'), sidecar['fastq_filenames']) == (stat.st_size, stat.st_mtime, source_key(fastq_filenames), sorted(fastq_filenames)):
+                md5sums[archive_filename] = sidecar['md5sum']
+                continue
+        stale[archive_filename] = fastq_filenames
+    if not stale:
+        return md5sums, list()
+    with contextlib.ExitStack() as stack:
+        hashes = {archive_filename: hashlib.md5() for archive_filename in stale}
+        archives = {archive_filename: stack.enter_context(tarfile.open(fileobj=HashingWriter(stack.enter_context(open(archive_filename, 'wb')), hashes[archive_filename]), mode='w|', bufsize=block_size))
+                    for archive_filename in stale}
+        if tar_archive:
+            archive_of = {fastq_filename: archive_filename for archive_filename, fastq_filenames in stale.items() for fastq_filename in fastq_filenames}
+            with tarfile.open(tar_archive, mode='r|*', bufsize=block_size) as tar:
+                for member in tar:
+                    if member.isfile() and os.path.basename(member.name) in archive_of:
+                        archives[archive_of[os.path.basename(member.name)]].addfile(member, tar.extractfile(member))
+        else:
+            for archive_filename, fastq_filenames in stale.items():
+                for fastq_filename in sorted(fastq_filenames):
+                    archives[archive_filename].add(os.path.join(fastq_dir, fastq_filename), arcname=fastq_filename)
+    for archive_filename, fastq_filenames in stale.items():
+        md5sums[archive_filename] = hashes[archive_filename].hexdigest()
+        stat = os.stat(archive_filename)
+        with open(archive_filename + '.md5.json', 'w') as file:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime, 'md5sum': md5sums[archive_filename], 'fastq_filenames': sorted(fastq_filenames), 'source': source_key(fastq_filenames)}, file)
+    return md5sums, sorted(stale)
+
+
+def remove_study_outputs(working_dir, study_id):
+    """ Remove the outputs a study's build state in working_dir records, and the state & reports saved with them. Returns the removed filenames """
+    removed = BuildState(os.path.join(working_dir, study_id + '.build_state.json')).remove()
+    for extension in ('.build_state.json', '.validation.json', '.report.json', '.prof', '.fastq.tar', '.fastq.tar.md5.json'):
+        filename = os.path.join(working_dir, study_id + extension)
+        if os.path.exists(filename):
+            os.remove(filename)
+            removed.append(filename)
+    return removed
+
+
+def remove_stale_packages(working_dir, study_id, n_packages=0):
+    """ Remove the study's outputs from the package<n> directories in working_dir past its last package, and the directories they leave empty.
+    Directories with other files in them, e.g. experiment metadata filled in by the user, are kept and listed. Returns the removed filenames
+    """
+    removed = list()
+    kept = list()
+    for entry in sorted(os.scandir(working_dir), key=lambda entry: entry.name):
+        match = re.fullmatch(r'package(\d+)', entry.name)
+        if entry.is_dir() and match and int(match.group(1)) > n_packages and os.path.exists(os.path.join(entry.path, study_id + '.build_state.json')):
+            removed += remove_study_outputs(entry.path, study_id)
+            if os.listdir(entry.path):
+                kept.append(entry.path)
+            else:
+                os.rmdir(entry.path)
+    if kept:  # printed at once so studies prepared in parallel don't interleave their lines
+        print('\n'.join(['Left {}, which is no longer a package of {}, because it has files this program did not make'.format(path, study_id) for path in kept]))
+    return removed
+
+
+def hash_inputs(*inputs):
+    return hashlib.md5(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_columns(columns):
+    """ hash_inputs of {column: values} with missing values as None, so the lists either backend makes of the same data hash the same """
+    return hash_inputs({column: [None if value != value else value for value in values] for column, values in columns.items()})
+
+
+def compile_template(templates_dir, name, is_time_series, cache_dir=None):
+    """ Load a template indexed by property, with the rows in TEMPLATE_LAYOUTS dropped & inserted.
+    Compiled templates are kept for the rest of the process, and in cache_dir keyed by the template's content
+    """
+    template_filename = os.path.join(templates_dir, name + '.template.tsv')
+    if (template_filename, is_time_series) in TEMPLATES:
+        return TEMPLATES[(template_filename, is_time_series)]
+    layout = TEMPLATE_LAYOUTS.get(name, dict())
+    cache_filename = None
+    if cache_dir:
+        key = hashlib.md5(file_md5(template_filename).encode())
+        key.update(repr((layout, is_time_series)).encode())
+        cache_filename = os.path.join(cache_dir, '{}.{}.template.pkl'.format(name, key.hexdigest()))
+    if cache_filename and os.path.exists(cache_filename):
+        template = pd.read_pickle(cache_filename)
+    else:
+        template = pd.read_csv(template_filename, sep='\t').set_index('#property').drop(layout.get('drop', list()))
+        for position, prop, row in layout.get('insert', list()) + (layout.get('time_series_insert', list()) if is_time_series else list()):
+            row = template.loc[[row]] if isinstance(row, str) else pd.DataFrame([row], columns=template.columns)
+            row.index = pd.Index([prop], name=template.index.name)
+            template = pd.concat([template.iloc[:position], row, template.iloc[position:]])
+        if cache_filename:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+            template.to_pickle(cache_filename)
+    TEMPLATES[(template_filename, is_time_series)] = template
+    return template
+
+
+def compile_table_template(templates_dir, name, is_time_series):
+    """ compile_template without pandas, as a Table indexed by property """
+    template_filename = os.path.join(templates_dir, name + '.template.tsv')
+    if (template_filename, is_time_series, 'python') in TEMPLATES:
+        return TEMPLATES[(template_filename, is_time_series, 'python')]
+    layout = TEMPLATE_LAYOUTS.get(name, dict())
+    table = read_table(template_filename)
+    position = table.columns.index('#property')
+    columns = table.columns[:position] + table.columns[position + 1:]
+    not_found = set(layout.get('drop', list())) - set(row[position] for row in table.rows)
+    if not_found:
+        raise KeyError('{} not found in {}'.format(sorted(not_found), template_filename))
+    index, rows = list(), list()
+    for row in table.rows:
+        if row[position] not in layout.get('drop', list()):
+            index.append(row[position])
+            rows.append(row[:position] + row[position + 1:])
+    for insert_position, prop, row in layout.get('insert', list()) + (layout.get('time_series_insert', list()) if is_time_series else list()):
+        new_rows = [list(values) for label, values in zip(index, rows) if label == row] if isinstance(row, str) else [[row.get(column) for column in columns]]
+        index[insert_position:insert_position] = [prop] * len(new_rows)
+        rows[insert_position:insert_position] = new_rows
+    template = Table(columns, rows, index=index, index_name='#property')
+    TEMPLATES[(template_filename, is_time_series, 'python')] = template
+    return template
+
+
+def template_validator(templates_dir, name, is_time_series):
+    """ Validator for the documents filled from a template, compiled once per process """
+    template_filename = os.path.join(templates_dir, name + '.template.tsv')
+    if (template_filename, is_time_series) not in VALIDATORS:
+        VALIDATORS[(template_filename, is_time_series)] = Validator(compile_table_template(templates_dir, name, is_time_series))
+    return VALIDATORS[(template_filename, is_time_series)]
+
+
+def compile_check(domain):
+    """ Check of the present values of a template domain, e.g. enum(Yes, No), as (kind, argument, error).
+    kind is 'enum' with a set of options, 'pattern' with a regex values must match, 'empty', or None for domains that aren't checked like string
+    """
+    name, _, argument = domain.partition('(')
+    argument = argument[:-1] if argument.endswith(')') else argument
+    if name == 'enum':
+        return 'enum', {option.strip() for option in argument.split(',')}, 'not one of ' + argument
+    if name == '[valueless]':
+        return 'empty', None, 'should be empty'
+    if name == 'regexp':
+        pattern = re.compile(argument)
+    elif name == 'autoID':  # e.g. autoID(EXR, uniqAlphaNum, DO) for EXR-MTEWA1hc1-DO
+        prefix, _, suffix = [part.strip() for part in argument.split(',')]
+        pattern = re.compile(re.escape(prefix) + '-[a-zA-Z0-9]+-' + re.escape(suffix))
+    elif name == 'measurement':
+        pattern = re.compile(r'[-+]?(\d+\.?\d*|\.\d+)\s*' + re.escape(argument.strip()))
+    elif name in DOMAIN_PATTERNS:
+        pattern = re.compile(DOMAIN_PATTERNS[name])
+    else:
+        return None, None, None
+    return 'pattern', pattern, 'does not match ' + domain
+
+
+def check_value(check, value):
+    """ What's wrong with a present value, or None """
+    kind, argument, error = check
+    text = str(value).strip()
+    if (kind == 'enum' and text not in argument) or (kind == 'pattern' and not argument.fullmatch(text)) or kind == 'empty':
+        return error
+    return None
+
+
+def suspect_values(values, counts, domain, check):
+    """ The distinct values of a row (a Series) & their counts that are missing, duplicate IDs or fail the check, found with column operations """
+    kind, argument, error = check
+    text = values.astype(str).str.strip()
+    suspect = values.isnull() | text.isin(['', MISSING])
+    if kind == 'enum':
+        suspect |= ~text.isin(argument)
+    elif kind == 'pattern':
+        suspect |= ~text.str.fullmatch(argument.pattern).fillna(False).astype(bool)
+    elif kind == 'empty':
+        suspect[:] = True
+    if domain.startswith('autoID'):
+        suspect |= counts > 1
+    return values[suspect].tolist(), counts[suspect].tolist()
+
+
+def value_counts(document, n_template_columns):
+    """ (distinct values, counts) across the records of each row of a filled document, as lists for a Table or Series for a MetaDataFrame """
+    if isinstance(document, Table):
+        return [tuple(map(list, zip(*collections.Counter(row[:len(row) - n_template_columns]).items()))) or ([], []) for row in document.rows]
+    rows = document.df.iloc[:, :len(document.df.columns) - n_template_columns].to_numpy()
+    if rows.shape[1] < VECTORIZED_VALIDATION_MIN_RECORDS:
+        return [tuple(map(list, zip(*collections.Counter(None if value != value else value for value in row.tolist()).items()))) or ([], []) for row in rows]
+    return [(pd.Series(counts.index, dtype=object), pd.Series(counts.to_numpy())) for counts in (pd.Series(row).value_counts(dropna=False) for row in rows)]
+
+
+def read_table(filename, columns=None, keep=None, text_columns=()):
+    """ Read a csv (or tsv) file into a Table without pandas, converting each column to the type read_csv would infer from the whole file.
+    columns: the columns to read, default all
+    keep: function of a row's raw values (in the order of columns) that's true for the rows to keep
+    text_columns: columns kept as strings, like read_csv's category dtype
+    """
+    with open(filename, 'r', newline='', encoding='utf-8-sig') as file:
+        reader = csv.reader(file, delimiter='\t' if filename.endswith('.tsv') else ',')
+        header = next(reader)
+        columns = columns or header
+        positions = [header.index(column) for column in columns]
+        values_seen = [set() for column in columns]
+        rows = list()
+        for row in reader:
+            if not row:
+                continue
+            values = [row[position] if position < len(row) else '' for position in positions]
+            for seen, value in zip(values_seen, values):
+                seen.add(value)
+            if keep is None or keep(values):
+                rows.append(values)
+    converters = [column_converter(seen, text=column in text_columns) for column, seen in zip(columns, values_seen)]
+    return Table(list(columns), [[None if value in NA_VALUES else convert(value) for convert, value in zip(converters, row)] for row in rows])
+
+
+def column_converter(values, text=False):
+    """ Function converting a column's non-missing raw values to the type read_csv would infer from all of them: str, bool, int or float """
+    kinds = set()
+    for value in values:
+        if value in NA_VALUES:
+            kinds.add(None)
+        elif value in BOOL_VALUES:
+            kinds.add(bool)
+        elif INT_PATTERN.fullmatch(value):
+            kinds.add(int)
+        elif FLOAT_PATTERN.fullmatch(value):
+            kinds.add(float)
+        else:
+            kinds.add(str)
+    if text or str in kinds:
+        return str
+    if kinds <= {bool, None} and bool in kinds:
+        return BOOL_VALUES.get
+    if kinds == {int}:
+        return int
+    if kinds <= {int, float, None}:  # integers with missing values are floats, as are columns with nothing in them
+        return float
+    return str
+
+
+def max_rss():
+    """ Peak resident memory of the process so far in bytes, or None where the resource module isn't available """
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)  # kilobytes on linux
+
+
+def rss():
+    """ Resident memory of the process now in bytes, or None where /proc isn't available """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):  # not on linux
+        return None
+
+
+def file_md5(filename, block_size=2 ** 20):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def strip_digits(label, strip_asterisks=False):
+    return ''.join(l for l in label if not l.isdigit() and not (strip_asterisks and l == '*'))
+
+
+def fill_template(template, column_names, fields):
+    """ Build a wide metadata document from a cleaned template in one pass.
+    template: dataframe indexed by property with 'value', 'domain', 'default', 'required' & 'description' columns
+    column_names: one value column name per record (digits & asterisks are stripped)
+    fields: {property: scalar or sequence with one value per record}
+    """
+    # every record starts as a copy of the template's value column
+    values = np.empty((len(template.index), len(column_names)), dtype=object)
+    values[:] = template['value'].values.astype(object)[:, np.newaxis]
+    for prop, value in fields.items():
+        values[template.index.get_loc(prop), :] = value if np.isscalar(value) else np.asarray(value, dtype=object)
+    document = pd.concat([pd.DataFrame(values, index=template.index, columns=[strip_digits(col, strip_asterisks=True) for col in column_names]),
+                          template.drop('value', axis=1)], axis=1)
+    document.index = pd.Index([strip_digits(prop) for prop in template.index], name=template.index.name)
+    return document
+
+
+def fill_table(template, column_names, fields):
+    """ fill_template for a Table """
+    not_found = set(fields) - set(template.index)
+    if not_found:
+        raise KeyError('{} not found in the template'.format(sorted(not_found)))
+    value_position = template.columns.index('value')
+    rows = list()
+    for prop, row in zip(template.index, template.rows):
+        value = fields.get(prop, row[value_position])
+        rows.append((list(value) if isinstance(value, list) else [value] * len(column_names)) + row[:value_position] + row[value_position + 1:])
+    return Table([strip_digits(col, strip_asterisks=True) for col in column_names] + template.columns[:value_position] + template.columns[value_position + 1:], rows,
+                 index=[strip_digits(prop) for prop in template.index], index_name=template.index_name)
+
+
+def load_config(config_filename):
+    with open(config_filename, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def find_configs(config_paths):
+    config_filenames = list()
+    for path in config_paths:
+        if os.path.isdir(path):
+            config_filenames.extend(sorted(glob.glob(os.path.join(path, '*.yaml')) + glob.glob(os.path.join(path, '*.yml'))))
+        else:
+            config_filenames.append(path)
+    return config_filenames
+
+
+def init_batch_worker(sample_sheets, templates):
+    SAMPLE_SHEETS.update(sample_sheets)
+    TEMPLATES.update(templates)
+
+
+def prepare_study(config_filename, report=False, profile=False):
+    """ Prepare one study of a batch. Returns (config_filename, study_id, seconds, error) so one failure doesn't stop the others """
+    start = time.time()
+    study_id = None
+    try:
+        config = load_config(config_filename)
+        study_id = config['study_id']
+        if not os.path.exists(config['working_dir']):
+            os.makedirs(config['working_dir'])
+        Submission.from_config_dict(config, sample_sheet=SAMPLE_SHEETS.get((config['samples_filename'], config.get('cache_dir'))), report=report, profile=profile, processes=1)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return config_filename, study_id, time.time() - start, error
+
+
+def prepare_package(config, sample_sheet, donor_ids, biosample_ids, package, study_sources, report=False, profile=False):
+    """ Prepare one package of a study. Returns (rebuilt filenames, removed filenames, filenames left to fill in) """
+    if not os.path.exists(config['working_dir']):
+        os.makedirs(config['working_dir'])
+    submission = Submission.from_config_dict(config, sample_sheet=sample_sheet, report=report, profile=profile, donor_ids=donor_ids, biosample_ids=biosample_ids, package=package, study_sources=study_sources)
+    return submission.rebuilt, submission.removed, submission.filenames
+
+
+def batch(config_paths, processes=None, report=False, profile=False):
+    start = time.time()
+    config_filenames = find_configs(config_paths)
+
+    # parse each sample sheet and template once, with every study any config needs from it
+    study_names = dict()
+    templates = dict()
+    for config_filename in config_filenames:
+        try:
+            config = load_config(config_filename)
+            study_names.setdefault((config['samples_filename'], config.get('cache_dir')), set()).update(config['sample_study_names'])
+            for name in TEMPLATE_NAMES:
+                template = compile_template(config['templates_dir'], name, config['is_time_series'], cache_dir=config.get('cache_dir'))
+                templates[(os.path.join(config['templates_dir'], name + '.template.tsv'), config['is_time_series'])] = template
+        except Exception:  # reported when the study itself is prepared
+            continue
+    sample_sheets = dict()
+    for (samples_filename, cache_dir), names in study_names.items():
+        try:
+            sample_sheets[(samples_filename, cache_dir)] = SampleSheet(samples_filename, sorted(names), cache_dir=cache_dir).df
+        except Exception:
+            continue
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_batch_worker, initargs=(sample_sheets, templates)) as executor:
+        results = list(executor.map(functools.partial(prepare_study, report=report, profile=profile), config_filenames))
+
+    failures = [result for result in results if result[3]]
+    print('Prepared {} of {} studies in {}'.format(len(results) - len(failures), len(results), datetime.timedelta(seconds=time.time() - start)))
+    for config_filename, study_id, seconds, error in results:
+        print('\t{}\t{}\t{}\t{}'.format(config_filename, study_id, datetime.timedelta(seconds=seconds), 'FAILED' if error else 'ok'))
+    for config_filename, study_id, seconds, error in failures:
+        print('\n{} failed:\n{}'.format(config_filename, error))
+    return len(failures) == 0
 
 
 def main(args):
+    if args['batch']:
+        return batch(args['<config_path>'], processes=int(args['--processes']) if args['--processes'] else None, report=args['--report'], profile=args['--profile'])
     start = time.time()
-    with open(args['<config_filename>'], 'r') as file:
-        config = yaml.load(file)
+    config = load_config(args['<config_filename>'])
     print('Configuration:')
     pprint.pprint(config)
     if not os.path.exists(config['working_dir']):
         os.mkdir(config['working_dir'])
-    submission = Submission.from_config_dict(config)
+    submission = Submission.from_config_dict(config, report=args['--report'], profile=args['--profile'], backend=args['--backend'], processes=int(args['--processes']) if args['--processes'] else None)
     print('Prepared donors, biosamples, and manifest files for {} in {}'.format(config['study_id'], datetime.timedelta(seconds=time.time() - start)))
+    if isinstance(submission, PackagedSubmission):
+        print('Split into {} packages of {} to {} samples (max_samples_per_package: {}):'.format(len(submission.packages), min(submission.package_samples), max(submission.package_samples), config['max_samples_per_package']))
+        for working_dir, participant_ids, samples in zip(submission.working_dirs, submission.packages, submission.package_samples):
+            print('\t', working_dir, '({} participants, {} samples{})'.format(len(participant_ids), samples, ', too many' if samples > config['max_samples_per_package'] else ''))
+    print('Rebuilt {} file(s) whose inputs changed since the last run:'.format(len(submission.rebuilt)))
+    for filename in submission.rebuilt:
+        print('\t', filename)
+    if submission.removed:
+        print('Removed {} file(s) from earlier runs that are no longer made:'.format(len(submission.removed)))
+        for filename in submission.removed:
+            print('\t', filename)
     print("Don't forget to create and fill in the following files:")
-    for filename in submission.manifest.filenames:
+    for filename in submission.filenames:
         print('\t', filename)
+    return True
 
 
 if __name__ == "__main__":
     arguments = docopt.docopt(__doc__)
-    main(arguments)
+    if not main(arguments):
+        exit(1)
@@ -0,0 +1,288 @@
+""" Regression tests: the files prepared from the sample sheet in tests/data must be byte-identical to the ones the original script made from it,
+which are in tests/data/expected
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+import dmrr_prep
+
+DATA_DIR = os.path.join(REPO_DIR, 'tests', 'data')
+TEMPLATES_DIR = os.path.join(REPO_DIR, 'templates')
+# study_id, sample_study_names & is_time_series of each study in the sample sheet, by the name of its expected files' directory
+STUDIES = {'healthy_controls': ('EXR-MTEWA1hc', ['Healthy Controls'], False),
+           'single_source': ('EXR-MTEWA1ss', ['Single Source'], False),
+           'feeding_study': ('EXR-MTEWA1fs', ['Feeding Study-30 min', 'Feeding Study-1 hr'], True)}
+
+
+def study_config(study, working_dir, fastq_dir=False, **settings):
+    """ Config of a study in the sample sheet, with a copy of the fastq filenames next to working_dir so their index isn't saved in tests/data,
+    or with a directory of small fastq files by those names, which packaged studies need to make their packages' archives
+    """
+    study_id, sample_study_names, is_time_series = STUDIES[study]
+    fastq_filenames = os.path.join(os.path.dirname(str(working_dir)), 'fastq_filenames.txt')
+    shutil.copy(os.path.join(DATA_DIR, 'fastq_filenames.txt'), fastq_filenames)
+    if fastq_dir:
+        settings['fastq_dir'] = os.path.join(os.path.dirname(str(working_dir)), 'fastq')
+        os.makedirs(settings['fastq_dir'], exist_ok=True)
+        with open(fastq_filenames, 'r') as file:
+            for fastq_filename in file.read().split():
+                with open(os.path.join(settings['fastq_dir'], fastq_filename), 'w') as fastq_file:
+                    fastq_file.write('@{}\nACGT\n+\nFFFF\n'.format(fastq_filename))
+    config = {'group': 'exrna-mtewa1', 'user_login': 'sovacool', 'study_name': 'Test ' + study, 'samples_filename': os.path.join(DATA_DIR, 'sample_sheet.csv'),
+              'sample_study_names': sample_study_names, 'study_id': study_id, 'working_dir': str(working_dir), 'templates_dir': TEMPLATES_DIR,
+              'is_time_series': is_time_series, 'database': 'hg19_exrna', 'md5sum': 'daec25d670e3bb6b3ab3bbf5733df68c',
+              'fastq_filenames': fastq_filenames, 'tar_archive': None}
+    config.update(settings)
+    return config
+
+
+def read_output(filename):
+    """ The bytes of an output file, without the date the manifest's analysisName ends with """
+    with open(filename, 'rb') as file:
+        return re.sub(rb'("analysisName": "[^"]*_)\d{4}-\d{2}-\d{2}"', rb'\1DATE"', file.read())
+
+
+def assert_matches_expected(study, working_dir):
+    expected_dir = os.path.join(DATA_DIR, 'expected', study)
+    for filename in sorted(os.listdir(expected_dir)):
+        assert read_output(os.path.join(working_dir, filename)) == read_output(os.path.join(expected_dir, filename)), filename
+
+
+@pytest.mark.parametrize('backend', ['pandas', 'python'])
+@pytest.mark.parametrize('study', sorted(STUDIES))
+def test_matches_original(tmp_path, study, backend):
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    dmrr_prep.Submission.from_config_dict(study_config(study, working_dir), backend=backend)
+    assert_matches_expected(study, working_dir)
+
+
+@pytest.mark.parametrize('study', sorted(STUDIES))
+def test_backends_share_build_state(tmp_path, study):
+    """ Files built by one backend are current for the other, e.g. after a batch run (pandas) then a run of one small study (python) """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    config = study_config(study, working_dir)
+    assert dmrr_prep.Submission.from_config_dict(config, backend='pandas').rebuilt
+    assert dmrr_prep.Submission.from_config_dict(config, backend='python').rebuilt == []
+    assert dmrr_prep.Submission.from_config_dict(config, backend='pandas').rebuilt == []
+
+
+def test_chunked_sample_sheet_dtypes(tmp_path, monkeypatch):
+    """ A sample sheet read in chunks has the columns a single read_csv would give, even when IDs are numbers in some chunks and text in others """
+    samples_filename = str(tmp_path / 'sample_sheet.csv')
+    with open(samples_filename, 'w') as file:
+        file.write(','.join(dmrr_prep.SAMPLE_SHEET_COLUMNS) + '\n')
+        for participant in range(1, 26):
+            file.write('{0},{0:03d}-S,{1},Plasma,Numbered Study,PASS,{2},White,male\n'.format(participant, 2000 + participant, '' if participant == 7 else 30 + participant))
+            if participant == 15:
+                file.write('OTHER1,OTHER1,3000,Plasma,Other Study,PASS,40,Asian,female\n')
+    monkeypatch.setattr(dmrr_prep, 'CHUNK_SIZE', 10)
+    sample_sheet = dmrr_prep.SampleSheet(samples_filename, ['Numbered Study']).df
+    expected = dmrr_prep.pd.read_csv(samples_filename).loc[lambda df: df['Study'] == 'Numbered Study']
+    for column in ['Participant.ID', 'Sample.ID', 'MT.Unique.ID', 'Age']:
+        assert sample_sheet[column].dtype == expected[column].dtype, column
+        assert sample_sheet[column].tolist() == expected[column].tolist() or sample_sheet[column].equals(expected[column]), column
+
+
+def test_failed_run_stops_profiler(tmp_path):
+    """ A submission that fails part way, here on validation problems, doesn't leave the profiler running for the next study in a batch worker """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    with pytest.raises(ValueError):
+        dmrr_prep.Submission.from_config_dict(study_config('healthy_controls', working_dir, validation='error'), report=True, profile=True)
+    assert sys.getprofile() is None
+
+
+def test_stale_packages_removed(tmp_path):
+    """ A packaged study that fits in one submission again gets the original files, and its package directories are removed with the files in them """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    packaged = dmrr_prep.Submission.from_config_dict(study_config('single_source', working_dir, fastq_dir=True, max_samples_per_package=4), processes=1)
+    assert sorted(os.listdir(str(working_dir))) == ['package1', 'package2']
+    submission = dmrr_prep.Submission.from_config_dict(study_config('single_source', working_dir, max_samples_per_package=100))
+    assert sorted(submission.removed) == sorted(packaged.rebuilt + [os.path.join(path, 'EXR-MTEWA1ss' + extension) for path in packaged.working_dirs for extension in ('.build_state.json', '.validation.json', '.fastq.tar.md5.json')])
+    assert not any(name.startswith('package') for name in os.listdir(str(working_dir)))
+    assert_matches_expected('single_source', working_dir)
+
+
+@pytest.mark.parametrize('max_samples_per_package', [None, 4])
+def test_missing_fastq_stops_run(tmp_path, max_samples_per_package):
+    """ Every sample without exactly one fastq file per read is listed in one error, before any file of the study or its packages is written """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    config = study_config('single_source', working_dir, fastq_dir=True, max_samples_per_package=max_samples_per_package)
+    os.remove(os.path.join(config['fastq_dir'], '1017_S1017_L001_R1_001.fastq.gz'))
+    os.remove(os.path.join(config['fastq_dir'], '1020_S1020_L001_R1_001.fastq.gz'))
+    shutil.copy(os.path.join(config['fastq_dir'], '1024_S1024_L001_R1_001.fastq.gz'), os.path.join(config['fastq_dir'], '1024_S1024_L002_R1_001.fastq.gz'))
+    with pytest.raises(ValueError) as error:
+        dmrr_prep.Submission.from_config_dict(config, processes=1)
+    assert str(error.value).splitlines() == ['3 sample(s) with a missing or duplicate fastq file:', '\tMT.Unique.ID_1017\tno fastq file', '\tMT.Unique.ID_1020\tno fastq file',
+                                             '\tMT.Unique.ID_1024\t2 read 1 fastq files: 1024_S1024_L001_R1_001.fastq.gz, 1024_S1024_L002_R1_001.fastq.gz']
+    assert os.listdir(str(working_dir)) == []
+
+
+def test_fastq_read_1():
+    """ The manifest lists read 1 of paired-end samples, and a sample with only read 2 is a problem rather than listed with its mate """
+    index = dmrr_prep.FastqIndex(['1_S1_L001_R2_001.fastq.gz', '1_S1_L001_R1_001.fastq.gz', '2_S2_L001_R2_001.fastq.gz', '3_S3_L001_001.fastq.gz'])
+    assert index.resolve([1, 3]) == {1: '1_S1_L001_R1_001.fastq.gz', 3: '3_S3_L001_001.fastq.gz'}
+    with pytest.raises(ValueError) as error:
+        index.resolve([1, 2, 3])
+    assert str(error.value).splitlines() == ['1 sample(s) with a missing or duplicate fastq file:', '\tMT.Unique.ID_2\tno read 1 fastq file, only: 2_S2_L001_R2_001.fastq.gz']
+
+
+def test_report_memory(tmp_path):
+    """ Each stage of the run report says how much it raised the peak resident memory, which can't exceed the peak itself """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    report = dmrr_prep.Submission.from_config_dict(study_config('healthy_controls', working_dir), report=True).report
+    assert [stage['name'] for stage in report['stages']] == ['SampleSheet', 'Samples', 'Participants', 'BuildState', 'Donors', 'Biosamples', 'Manifest', 'Validate', 'write']
+    for stage in report['stages']:
+        if dmrr_prep.resource is not None:
+            assert 0 <= stage['max_rss_delta_bytes'] <= stage['max_rss_bytes']
+        assert 'peak_memory_bytes' not in stage
+
+
+def write_tar(tar_filename, mode):
+    """ A small archive of fastq files in a directory, with a file that isn't a fastq """
+    with tarfile.open(tar_filename, mode) as tar:
+        for name, data in [('reads/1001_S1001_L001_R1_001.fastq.gz', b'@read1\nACGT\n+\nFFFF\n' * 50), ('reads/1002_S1002_L001_R1_001.fastq', b'@read2\nTTGA\n+\nFFFF\n'), ('reads/README.txt', b'not reads')]:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(tar_filename, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+
+@pytest.mark.parametrize('background', [False, True])
+@pytest.mark.parametrize('mode', ['w:gz', 'w'])
+def test_tar_archive(tmp_path, mode, background):
+    """ The md5sum of every byte of the archive, padding after the end-of-archive marker included, and its fastq files, read in small blocks to stream it """
+    tar_filename = str(tmp_path / 'reads.tar')
+    md5sum = write_tar(tar_filename, mode)
+    archive = dmrr_prep.TarArchive(tar_filename, block_size=1024)
+    archive.scan(background=background)
+    assert archive.result() == (md5sum, ['1001_S1001_L001_R1_001.fastq.gz', '1002_S1002_L001_R1_001.fastq'])
+
+
+def test_tar_archive_sidecar(tmp_path):
+    """ The checksum saved next to the archive is reused until the archive's size or modification time changes """
+    tar_filename = str(tmp_path / 'reads.tar')
+    md5sum = write_tar(tar_filename, 'w')
+    assert dmrr_prep.TarArchive(tar_filename).result()[0] == md5sum
+    with open(tar_filename + '.md5.json', 'r') as file:
+        sidecar = json.load(file)
+    with open(tar_filename + '.md5.json', 'w') as file:
+        json.dump(dict(sidecar, md5sum='cached'), file)
+    assert dmrr_prep.TarArchive(tar_filename).result()[0] == 'cached'
+    os.utime(tar_filename, (sidecar['mtime'] + 10, sidecar['mtime'] + 10))
+    assert dmrr_prep.TarArchive(tar_filename).result()[0] == md5sum
+    with open(tar_filename, 'ab') as file:  # more padding, so a different size
+        file.write(bytes(512))
+    with open(tar_filename, 'rb') as file:
+        padded_md5sum = hashlib.md5(file.read()).hexdigest()
+    os.utime(tar_filename, (sidecar['mtime'] + 10, sidecar['mtime'] + 10))
+    assert dmrr_prep.TarArchive(tar_filename).result() == (padded_md5sum, ['1001_S1001_L001_R1_001.fastq.gz', '1002_S1002_L001_R1_001.fastq'])
+
+
+CHECKS_TEMPLATE = '''#property\tvalue\tdomain\tdefault\trequired\tdescription
+Donor\t\tautoID(EXR, uniqAlphaNum, DO)\t\tTRUE\tid
+- Status\t\tenum(Add, Modify)\tAdd\tTRUE\tstatus
+- Age\t\tmeasurement(years)\t\tTRUE\tage
+- Health Status\t\t[valueless]\t\t\tsection
+-- Notes\t\tstring\t\t\tnotes
+'''
+
+
+@pytest.mark.parametrize('path', ['table', 'counter', 'vectorized'])
+def test_validator(tmp_path, monkeypatch, path):
+    """ The python backend's tables, and small & large dataframes (counted without & with pandas), give the same problems, each distinct bad value once """
+    (tmp_path / 'Checks.template.tsv').write_text(CHECKS_TEMPLATE)
+    templates_dir = str(tmp_path)
+    fields = {'Donor': ['EXR-MTEWA1t1-DO', 'EXR-MTEWA1t1-DO', 'EXR-MTEWA1t2-DO', 'bad id', 'EXR-MTEWA1t3-DO', 'EXR-MTEWA1t4-DO'],
+              '- Status': ['Add', 'Add', 'Maybe', 'Add', 'Modify', 'Maybe'],
+              '- Age': ['25 years', '40 years', 'old', '#MISSING#', '31 years', None],
+              '- Health Status': [None, None, 'healthy', None, None, None],
+              '-- Notes': ['#MISSING#', None, 'x', 'x', 'x', 'x']}
+    column_names = ['value{}'.format(record) for record in range(6)]
+    if path == 'table':
+        document = dmrr_prep.fill_table(dmrr_prep.compile_table_template(templates_dir, 'Checks', False), column_names, fields)
+    else:
+        monkeypatch.setattr(dmrr_prep, 'VECTORIZED_VALIDATION_MIN_RECORDS', 1 if path == 'vectorized' else 10 ** 6)
+        document = dmrr_prep.MetaDataFrame(dataframe=dmrr_prep.fill_template(dmrr_prep.compile_template(templates_dir, 'Checks', False), column_names, fields))
+    problems = dmrr_prep.template_validator(templates_dir, 'Checks', False).validate(document)
+    autoid, enum, measurement = 'autoID(EXR, uniqAlphaNum, DO)', 'enum(Add, Modify)', 'measurement(years)'
+    assert problems == [{'property': 'Donor', 'domain': autoid, 'value': 'EXR-MTEWA1t1-DO', 'count': 2, 'error': 'duplicate ID'},
+                        {'property': 'Donor', 'domain': autoid, 'value': 'bad id', 'count': 1, 'error': 'does not match ' + autoid},
+                        {'property': '- Status', 'domain': enum, 'value': 'Maybe', 'count': 2, 'error': 'not one of Add, Modify'},
+                        {'property': '- Age', 'domain': measurement, 'value': '#MISSING#', 'count': 1, 'error': 'required value missing'},
+                        {'property': '- Age', 'domain': measurement, 'value': None, 'count': 1, 'error': 'required value missing'},
+                        {'property': '- Age', 'domain': measurement, 'value': 'old', 'count': 1, 'error': 'does not match ' + measurement},
+                        {'property': '- Health Status', 'domain': '[valueless]', 'value': 'healthy', 'count': 1, 'error': 'should be empty'},
+                        {'property': '-- Notes', 'domain': 'string', 'value': '#MISSING#', 'count': 1, 'error': 'missing value'}]
+    json.dumps(problems)  # saved in the validation report
+
+
+def test_oversized_packages(tmp_path, capsys):
+    """ A participant's 11 timepoints stay in one package even when that's over max_samples_per_package, and those packages are named in a warning """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    submission = dmrr_prep.Submission.from_config_dict(study_config('feeding_study', working_dir, fastq_dir=True, max_samples_per_package=5), processes=1)
+    assert submission.package_samples == [11] * len(submission.packages)
+    warning = [line for line in capsys.readouterr().out.splitlines() if line.startswith('Warning')]
+    assert warning == ['Warning: {0} of {0} packages have more than max_samples_per_package (5) samples, because one participant has more samples than that: {1}'.format(
+        len(submission.packages), ', '.join('package{} (11 samples)'.format(package) for package in range(1, len(submission.packages) + 1)))]
+
+
+@pytest.mark.parametrize('backend', ['python', 'auto'])
+def test_package_limit_keeps_backend(tmp_path, backend):
+    """ Setting max_samples_per_package doesn't force pandas on a study that fits in one submission """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    submission = dmrr_prep.Submission.from_config_dict(study_config('single_source', working_dir, max_samples_per_package=100), backend=backend)
+    assert type(submission) is dmrr_prep.LightSubmission
+    assert_matches_expected('single_source', working_dir)
+    assert type(dmrr_prep.Submission.from_config_dict(study_config('single_source', working_dir, fastq_dir=True, max_samples_per_package=4), backend=backend, processes=1)) is dmrr_prep.PackagedSubmission
+
+
+@pytest.mark.parametrize('source', ['fastq_dir', 'tar_archive'])
+def test_package_archives(tmp_path, source):
+    """ Each package gets an archive of just the fastq files its manifest lists, and its manifest has that archive's md5sum, so it can be uploaded on its own """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    config = study_config('single_source', working_dir, fastq_dir=True, max_samples_per_package=4)
+    if source == 'tar_archive':
+        config['tar_archive'] = str(tmp_path / 'reads.tar.gz')
+        with tarfile.open(config['tar_archive'], 'w:gz') as tar:
+            tar.add(config.pop('fastq_dir'), arcname='reads')
+    submission = dmrr_prep.Submission.from_config_dict(config, processes=1)
+    assert len(submission.packages) == 2
+    for working_dir, archive_filename in zip(submission.working_dirs, submission.archive_filenames):
+        with open(os.path.join(working_dir, 'EXR-MTEWA1ss.manifest.json'), 'r') as file:
+            manifest = json.load(file)
+        with open(archive_filename, 'rb') as file:
+            assert manifest['md5CheckSum'] == hashlib.md5(file.read()).hexdigest()
+        with tarfile.open(archive_filename) as tar:
+            members = {os.path.basename(member.name): tar.extractfile(member).read() for member in tar}
+        assert sorted(members) == sorted(sample['dataFileName'] for sample in manifest['manifest'])
+        assert all(data == '@{}\nACGT\n+\nFFFF\n'.format(name).encode() for name, data in members.items())
+    assert dmrr_prep.Submission.from_config_dict(config, processes=1).rebuilt == []
+
+
+def test_packages_need_archives(tmp_path):
+    """ A list of fastq filenames & one md5sum can't give each package its own checksum """
+    working_dir = tmp_path / 'out'
+    working_dir.mkdir()
+    with pytest.raises(ValueError, match='set tar_archive or fastq_dir'):
+        dmrr_prep.Submission.from_config_dict(study_config('single_source', working_dir, max_samples_per_package=4), processes=1)
+    assert os.listdir(str(working_dir)) == []